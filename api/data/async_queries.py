@@ -0,0 +1,42 @@
+import asyncio
+from functools import partial, wraps
+from concurrent.futures import ThreadPoolExecutor
+from api.data import queries
+from api.data.queries import DB_POOL_MAX
+
+# one worker per pooled connection, extra queries wait for a free worker
+# instead of blocking a thread on the connection pool
+executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX)
+
+
+def awaitable(func):
+    """
+    Turn a synchronous query function into a coroutine function that runs it on
+    the query executor, so it does not block the event loop
+    """
+
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+    return wrapper
+
+
+get_tables = awaitable(queries.get_tables)
+get_data_versions = awaitable(queries.get_data_versions)
+list_departments = awaitable(queries.list_departments)
+get_departments_population = awaitable(queries.get_departments_population)
+get_municipalities_by_department = awaitable(queries.get_municipalities_by_department)
+get_municipalities_population = awaitable(queries.get_municipalities_population)
+get_cases = awaitable(queries.get_cases)
+get_interfamily_violence_cases = awaitable(queries.get_interfamily_violence_cases)
+get_suicide_cases = awaitable(queries.get_suicide_cases)
+get_suicide_attempts = awaitable(queries.get_suicide_attempts)
+get_case_clusters = awaitable(queries.get_case_clusters)
+get_departments_population_series = awaitable(queries.get_departments_population_series)
+get_municipalities_population_series = awaitable(
+    queries.get_municipalities_population_series
+)
+get_case_series = awaitable(queries.get_case_series)
+get_case_rollup = awaitable(queries.get_case_rollup)
@@ -0,0 +1,97 @@
+from typing import List
+
+# case tables by the name used in the api, along with the column their
+# counts are returned as. Table names are only ever taken from here
+CASE_TABLES = {
+    "interfamily_violence": ("interfamilyViolence", "violence_cases"),
+    "suicides": ("suicides", "suicides"),
+    "suicide_attempts": ("suicideAttemptsYearly", "suicide_attempts"),
+}
+
+# metrics computed along with the cases of each municipality. The rate is the
+# number of cases per 100k inhabitants, ranks go from the highest rate down and
+# percentile buckets from the lowest rate up
+CASE_METRICS = {
+    "rate": "round(rate, 2) AS rate",
+    "department_rank": (
+        "rank() OVER (PARTITION BY department_code ORDER BY rate DESC NULLS LAST)"
+        " AS department_rank"
+    ),
+    "national_rank": "rank() OVER (ORDER BY rate DESC NULLS LAST) AS national_rank",
+    "percentile": (
+        "CASE WHEN rate IS NOT NULL THEN"
+        " ntile(%(buckets)s) OVER (PARTITION BY rate IS NULL ORDER BY rate)"
+        " END AS percentile"
+    ),
+}
+PERCENTILE_BUCKETS = 5
+
+
+def case_columns(case: str) -> List[str]:
+    """
+    Columns of the records of a case table, not counting metrics
+    """
+    _, count_column = CASE_TABLES[case]
+    return [
+        "municipality_name",
+        "municipality_code",
+        "department_name",
+        "department_code",
+        "population",
+        count_column,
+        "latitude",
+        "longitude",
+    ]
+
+
+def case_query(case: str, metrics: List[str] = (), fields: List[str] = None) -> str:
+    """
+    Build the query for the cases of every municipality in a year, along with
+    the given metrics. Metrics are computed over every municipality of the year
+    before the records are filtered by department and paginated by municipality
+    code. Only the given fields are selected, by default every column and metric
+    """
+    table, count_column = CASE_TABLES[case]
+    columns = case_columns(case)
+    measured = ",\n            ".join(columns + [CASE_METRICS[m] for m in metrics])
+    select = ",\n        ".join(fields or columns + list(metrics))
+
+    return f"""--sql
+    WITH cases AS (
+        SELECT
+            m.name as municipality_name,
+            m.code as municipality_code,
+            d.name as department_name,
+            d.code as department_code,
+            mph.total as population,
+            c.count as {count_column},
+            CASE
+                WHEN m.latitude = 'NaN' THEN NULL
+                ELSE m.latitude
+            END AS latitude,
+            CASE
+                WHEN m.longitude = 'NaN' THEN NULL
+                ELSE m.longitude
+            END AS longitude,
+            c.count * 100000.0 / NULLIF(mph.total, 0) as rate
+        FROM {table} c
+        JOIN municipalities m
+            ON c.municipality_id = m.code
+        JOIN departments d
+            ON m.department_id = d.code
+        JOIN municipalityPopulationHistory mph
+            ON c.municipality_id = mph.municipality_id AND c.year = mph.year
+        WHERE c.year = %(year)s
+    ), measured AS (
+        SELECT
+            {measured}
+        FROM cases
+    )
+    SELECT
+        {select}
+    FROM measured
+    WHERE (%(department_id)s IS NULL OR department_code = %(department_id)s)
+        AND (%(after)s IS NULL OR municipality_code > %(after)s)
+    ORDER BY municipality_code
+    LIMIT %(limit)s
+    """
@@ -0,0 +1,201 @@
+import io
+import csv
+import orjson
+import importlib.util
+from decimal import Decimal
+from typing import Any, Iterator, List, Optional, Sequence, Tuple
+
+# columns are cursor description entries, with a name and a postgres type oid
+Batches = Iterator[Tuple[Sequence, List[Tuple]]]
+
+MEDIA_TYPES = {
+    "json": "application/json",
+    "csv": "text/csv",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+}
+ARROW_FORMATS = {"arrow", "parquet"}
+# pyarrow is only imported by the arrow and parquet encoders, so json responses
+# do not pay for loading it
+HAS_PYARROW = importlib.util.find_spec("pyarrow") is not None
+
+# arrow type names of postgres type oids. Numerics are read as floats and any
+# other type is sent as its string representation
+ARROW_TYPES = {
+    16: "bool_",  # boolean
+    20: "int64",  # bigint
+    21: "int16",  # smallint
+    23: "int32",  # integer
+    700: "float32",  # real
+    701: "float64",  # double precision
+    1700: "float64",  # numeric
+    25: "string",  # text
+    1042: "string",  # char
+    1043: "string",  # varchar
+    1082: "date32",  # date
+}
+
+
+def available_formats() -> List[str]:
+    if not HAS_PYARROW:
+        return [fmt for fmt in MEDIA_TYPES if fmt not in ARROW_FORMATS]
+    return list(MEDIA_TYPES)
+
+
+def negotiate(fmt: Optional[str], accept: Optional[str]) -> Optional[str]:
+    """
+    Pick the output format from the format query parameter or else from the
+    Accept header. Returns None if none of the requested formats is available
+    """
+    formats = available_formats()
+    if fmt is not None:
+        return fmt if fmt in formats else None
+    if not accept:
+        return "json"
+
+    by_media_type = {MEDIA_TYPES[fmt]: fmt for fmt in formats}
+    requested = []
+    for i, item in enumerate(accept.split(",")):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if quality > 0:
+            requested.append((-quality, i, media_type))
+
+    for _, _, media_type in sorted(requested):
+        if media_type in ("*/*", "application/*"):
+            return "json"
+        if media_type in by_media_type:
+            return by_media_type[media_type]
+    return None
+
+
+def _json_default(value: Any):
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+
+def encode_json(payload: Any) -> bytes:
+    """
+    Serialize a payload of python core datatypes with orjson
+    """
+    return orjson.dumps(payload, default=_json_default)
+
+
+class _Sink(io.RawIOBase):
+    """
+    Write only file object that keeps what was written until it is drained
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def encode_csv(batches: Batches) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    header = True
+    for columns, rows in batches:
+        if header:
+            writer.writerow([column.name for column in columns])
+            header = False
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def arrow_schema(columns: Sequence):
+    """
+    Arrow schema of the records of a query, from the postgres types of its
+    columns, so it does not depend on the values of the first batch
+    """
+    import pyarrow as pa
+
+    fields = []
+    for column in columns:
+        dtype = getattr(pa, ARROW_TYPES.get(column.type_code, "string"))()
+        fields.append(pa.field(column.name, dtype))
+    return pa.schema(fields)
+
+
+def _record_batch(rows: List[Tuple], schema):
+    """
+    Build an arrow record batch with a given schema from tuples
+    """
+    import pyarrow as pa
+
+    arrays = []
+    for i, field in enumerate(schema):
+        values = [row[i] for row in rows]
+        if pa.types.is_floating(field.type):
+            values = [float(v) if isinstance(v, Decimal) else v for v in values]
+        elif pa.types.is_string(field.type):
+            values = [v if v is None or isinstance(v, str) else str(v) for v in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def encode_arrow(batches: Batches) -> Iterator[bytes]:
+    import pyarrow as pa
+
+    sink = _Sink()
+    writer, schema = None, None
+    for columns, rows in batches:
+        if writer is None:
+            schema = arrow_schema(columns)
+            writer = pa.ipc.new_stream(sink, schema)
+        writer.write_batch(_record_batch(rows, schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def encode_parquet(batches: Batches) -> Iterator[bytes]:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    sink = _Sink()
+    writer, schema = None, None
+    for columns, rows in batches:
+        if writer is None:
+            schema = arrow_schema(columns)
+            writer = pq.ParquetWriter(sink, schema)
+        writer.write_table(pa.Table.from_batches([_record_batch(rows, schema)]))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+ENCODERS = {"csv": encode_csv, "arrow": encode_arrow, "parquet": encode_parquet}
+
+
+def encode(fmt: str, batches: Batches) -> Iterator[bytes]:
+    """
+    Encode batches of records, as yielded by stream_query, in a given format
+    """
+    return ENCODERS[fmt](batches)
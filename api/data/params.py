@@ -0,0 +1,72 @@
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from fastapi import HTTPException
+from api.data import cases
+
+
+def parse_metrics(metrics: Optional[str]) -> Tuple[str, ...]:
+    """
+    Validate a comma separated list of metrics, returned in a canonical order
+    so equivalent requests share their cached response
+    """
+    if not metrics:
+        return ()
+    requested = {metric.strip() for metric in metrics.split(",")}
+    unknown = requested - set(cases.CASE_METRICS)
+    if unknown:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Unknown metrics {sorted(unknown)}, "
+            f"available metrics are {list(cases.CASE_METRICS)}",
+        )
+    return tuple(metric for metric in cases.CASE_METRICS if metric in requested)
+
+
+def parse_fields(
+    case: str, fields: Optional[str], metrics: Tuple[str, ...]
+) -> Tuple[Optional[Tuple[str, ...]], Tuple[str, ...]]:
+    """
+    Validate a comma separated list of fields against the columns and metrics
+    of a case table. Metrics among the fields are added to the metrics.
+    Returns the fields in a canonical order, always including the municipality
+    code, and the metrics
+    """
+    if not fields:
+        return None, metrics
+    columns = cases.case_columns(case)
+    available = columns + list(cases.CASE_METRICS)
+    requested = {field.strip() for field in fields.split(",")}
+    unknown = requested - set(available)
+    if unknown:
+        raise HTTPException(
+            status_code=422,
+            detail=f"Unknown fields {sorted(unknown)}, "
+            f"available fields are {available}",
+        )
+    requested.add("municipality_code")
+    metrics = tuple(
+        metric
+        for metric in cases.CASE_METRICS
+        if metric in metrics or metric in requested
+    )
+    return tuple(field for field in available if field in requested), metrics
+
+
+def page_payload(limit: int) -> Callable[[List[Dict]], Dict]:
+    """
+    Payload of a page of records queried with one extra record, which tells
+    whether there is a next page. next is the after parameter to request it
+    """
+
+    def paginated_payload(data: Union[List[Dict], Dict]) -> Dict:
+        if isinstance(data, dict):
+            # compact shape
+            rows = data["rows"]
+            page = {"columns": data["columns"], "rows": rows[:limit]}
+            code = data["columns"].index("municipality_code")
+            next_after = rows[limit - 1][code] if len(rows) > limit else None
+        else:
+            page = data[:limit]
+            next_after = page[-1]["municipality_code"] if len(data) > limit else None
+        return {"data": page, "next": next_after}
+
+    return paginated_payload
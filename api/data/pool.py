@@ -0,0 +1,118 @@
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional
+from psycopg2 import OperationalError, InterfaceError
+from psycopg2.pool import ThreadedConnectionPool, PoolError
+from psycopg2.extensions import connection
+
+# errors raised when the connection breaks. OperationalError is also raised by
+# some failures of the query itself, like cancellations and deadlocks
+CONNECTION_ERRORS = (OperationalError, InterfaceError)
+
+
+def is_broken(conn: Optional[connection], error: Exception) -> bool:
+    """
+    Whether an error raised while using a connection, or while checking it out
+    if conn is None, was caused by the connection itself breaking
+    """
+    return conn is None or bool(conn.closed) or isinstance(error, InterfaceError)
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of database connections.
+
+    Checkouts block until a connection is free instead of failing when every
+    connection is in use. Connections idle for longer than healthcheck_interval
+    are pinged before being handed out and broken connections are replaced
+    transparently.
+    """
+
+    def __init__(
+        self,
+        minconn: int,
+        maxconn: int,
+        timeout: float = 30.0,
+        healthcheck_interval: float = 60.0,
+        **connect_kwargs,
+    ):
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._pool = ThreadedConnectionPool(minconn, maxconn, **connect_kwargs)
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used: Dict[int, float] = {}
+
+    def _is_alive(self, conn: connection) -> bool:
+        """
+        Check the connection is open, pinging it if it has been idle for a while
+        """
+        if conn.closed:
+            return False
+        last_used = self._last_used.get(id(conn), 0.0)
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except CONNECTION_ERRORS:
+            return False
+
+    def _discard(self, conn: connection):
+        self._last_used.pop(id(conn), None)
+        self._pool.putconn(conn, close=True)
+
+    def getconn(self) -> connection:
+        """
+        Check out a live connection, waiting up to timeout for a free one
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolError(f"no connection available after {self.timeout}s")
+        try:
+            while True:
+                conn = self._pool.getconn()
+                if self._is_alive(conn):
+                    return conn
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, conn: connection, close: bool = False):
+        """
+        Return a connection to the pool, closing it if it is broken
+        """
+        try:
+            if close or conn.closed:
+                self._discard(conn)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+                self._pool.putconn(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self) -> Iterator[connection]:
+        """
+        Context manager that checks out a connection and returns it on exit.
+        The transaction is rolled back if an error is raised and the connection
+        is discarded if the error left it closed
+        """
+        conn = self.getconn()
+        try:
+            yield conn
+        except BaseException:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except CONNECTION_ERRORS:
+                    pass
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def closeall(self):
+        self._pool.closeall()
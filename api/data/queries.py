@@ -1,44 +1,122 @@
 import os
 import boto3
-from typing import List, Dict, Union
+from typing import Iterator, List, Dict, Tuple, Union
 from api.data.utils import get_secret
-import psycopg2
-from psycopg2.extras import RealDictCursor
-from psycopg2.extensions import connection
+from api.data.cases import CASE_TABLES, PERCENTILE_BUCKETS, case_query
+from api.data.pool import ConnectionPool, CONNECTION_ERRORS, is_broken
+from psycopg2.errors import UndefinedTable
+from psycopg2.extensions import Column, DECIMAL, new_type, register_type
 
 
 SECRET_NAME = os.environ["SECRET_NAME"]
+# pool sizing. On lambda a container serves one request at a time, so
+# serverless.yml sets DB_POOL_MAX=1 there
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+DB_HEALTHCHECK_INTERVAL = float(os.environ.get("DB_HEALTHCHECK_INTERVAL", 60))
+DB_QUERY_RETRIES = int(os.environ.get("DB_QUERY_RETRIES", 1))
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 2000))
+
+# numeric columns, like coordinates, are returned as floats instead of Decimal
+DEC2FLOAT = new_type(
+    DECIMAL.values,
+    "DEC2FLOAT",
+    lambda value, cursor: float(value) if value is not None else None,
+)
+register_type(DEC2FLOAT)
 
 aws = boto3.Session()
 db_secret = get_secret(aws, SECRET_NAME)
-conn = psycopg2.connect(
+pool = ConnectionPool(
+    minconn=DB_POOL_MIN,
+    maxconn=DB_POOL_MAX,
+    timeout=DB_POOL_TIMEOUT,
+    healthcheck_interval=DB_HEALTHCHECK_INTERVAL,
     host=db_secret["host"],
     database=db_secret["dbname"],
     user=db_secret["username"],
     password=db_secret["password"],
+    connect_timeout=5,
+    keepalives=1,
+    keepalives_idle=30,
 )
 
 
-def query_db(conn: connection, query: str, values: List = None) -> List[Dict]:
+def query_rows(
+    pool: ConnectionPool, query: str, values: List = None
+) -> Tuple[List[str], List[Tuple]]:
     """
-    Generic function to query the database and return the records with
-    python core datatypes
+    Generic function to query the database and return the names of the columns
+    and the records as tuples with python core datatypes. Queries that fail
+    because the connection broke are retried on a fresh connection
     """
     if values is None:
         values = []
-    try:
-        cursor = conn.cursor(cursor_factory=RealDictCursor)
-        cursor.execute(query, values)
-        resultset = cursor.fetchall()
-        conn.commit()
-    except:
-        conn.rollback()
-        raise
+    for attempt in range(DB_QUERY_RETRIES + 1):
+        conn = None
+        try:
+            with pool.connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute(query, values)
+                resultset = cursor.fetchall()
+                columns = [column.name for column in cursor.description]
+                conn.commit()
+            break
+        except CONNECTION_ERRORS as e:
+            # failures of the query itself, like timeouts, are not retried
+            if attempt == DB_QUERY_RETRIES or not is_broken(conn, e):
+                raise
+
+    return columns, resultset
+
+
+def query_db(pool: ConnectionPool, query: str, values: List = None) -> List[Dict]:
+    """
+    Query the database and return the records as dicts
+    """
+    columns, resultset = query_rows(pool, query, values)
+    return [dict(zip(columns, row)) for row in resultset]
+
+
+def query_compact(pool: ConnectionPool, query: str, values: List = None) -> Dict:
+    """
+    Query the database and return the column names once and the records as
+    lists of values, which is smaller to build and to encode than dicts
+    """
+    columns, resultset = query_rows(pool, query, values)
+    return {"columns": columns, "rows": resultset}
+
 
-    return [dict(row) for row in resultset]
+def stream_query(
+    pool: ConnectionPool, query: str, values: List = None
+) -> Iterator[Tuple[List[Column], List[Tuple]]]:
+    """
+    Run a query on a server side cursor and yield the description of its
+    columns, with their names and type codes, along with batches of records as
+    tuples, so the result set is never fully loaded in memory. At least one,
+    possibly empty, batch is yielded. The connection is held until the
+    generator is exhausted or closed
+    """
+    if values is None:
+        values = []
+    with pool.connection() as conn:
+        with conn.cursor(name="stream_query") as cursor:
+            cursor.itersize = STREAM_BATCH_SIZE
+            cursor.execute(query, values)
+            first = True
+            while True:
+                rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+                if not rows and not first:
+                    break
+                yield cursor.description, rows
+                first = False
+                if not rows:
+                    break
+        conn.commit()
 
 
-def get_tables(conn: connection) -> List[Dict[str, str]]:
+def get_tables(pool: ConnectionPool) -> List[Dict[str, str]]:
     """
     Debug query to list public tables in the database
     """
@@ -47,10 +125,28 @@ def get_tables(conn: connection) -> List[Dict[str, str]]:
         WHERE table_schema = 'public'
     """
 
-    return query_db(conn, query)
+    return query_db(pool, query)
 
 
-def list_departments(conn: connection) -> List[Dict[str, Union[str, int]]]:
+def get_data_versions(pool: ConnectionPool) -> Dict[str, Dict]:
+    """
+    Query the data version of each table, bumped by ingest after every load.
+    Returns an empty dict if nothing has been ingested yet
+    """
+    query = """--sql
+    SELECT table_name, version, updated_at FROM dataVersions
+    """
+
+    try:
+        rows = query_db(pool, query)
+    except UndefinedTable:
+        return {}
+    return {row["table_name"]: row for row in rows}
+
+
+def list_departments(
+    pool: ConnectionPool, fetch=query_db
+) -> List[Dict[str, Union[str, int]]]:
     """
     Query the list of departments
     """
@@ -58,10 +154,10 @@ def list_departments(conn: connection) -> List[Dict[str, Union[str, int]]]:
     SELECT code, name FROM departments
     """
 
-    return query_db(conn, query)
+    return fetch(pool, query)
 
 
-def get_departments_population(conn: connection, year: int):
+def get_departments_population(pool: ConnectionPool, year: int, fetch=query_db):
     """
     Query the population of each department in a given year
     """
@@ -77,10 +173,12 @@ def get_departments_population(conn: connection, year: int):
     WHERE dph.year=%s
     """
 
-    return query_db(conn, query, [year])
+    return fetch(pool, query, [year])
 
 
-def get_municipalities_by_department(conn: connection, department_id: int):
+def get_municipalities_by_department(
+    pool: ConnectionPool, department_id: int, fetch=query_db
+):
     """
     Query the list of municipalities that belong to a given department
     """
@@ -100,10 +198,12 @@ def get_municipalities_by_department(conn: connection, department_id: int):
     WHERE department_id = %s 
     """
 
-    return query_db(conn, query, [department_id])
+    return fetch(pool, query, [department_id])
 
 
-def get_municipalities_population(conn: connection, department_id: int, year: int):
+def get_municipalities_population(
+    pool: ConnectionPool, department_id: int, year: int, fetch=query_db
+):
     """
     Get the population for a given year of the municipalities that belong to a 
     given department
@@ -118,107 +218,262 @@ def get_municipalities_population(conn: connection, department_id: int, year: in
     WHERE m.department_id = %s AND mph.year = %s 
     """
 
-    return query_db(conn, query, [department_id, year])
+    return fetch(pool, query, [department_id, year])
+
+
+def get_cases(
+    pool: ConnectionPool,
+    case: str,
+    year: int,
+    metrics: Tuple[str, ...] = (),
+    buckets: int = PERCENTILE_BUCKETS,
+    fields: Tuple[str, ...] = None,
+    department_id: int = None,
+    after: int = None,
+    limit: int = None,
+    fetch=query_db,
+):
+    """
+    Query the cases of a case table for each municipality for a given year, with
+    population, coordinates and the requested metrics. Records are ordered by
+    municipality code, optionally only those of a department and at most limit
+    of them with a code greater than after. Suicide attempts are read from their
+    yearly rollup maintained by ingest
+    """
+    query = case_query(case, metrics, fields)
+    values = {
+        "year": year,
+        "buckets": buckets,
+        "department_id": department_id,
+        "after": after,
+        "limit": limit,
+    }
+    return fetch(pool, query, values)
+
 
-def get_interfamily_violence_cases(conn: connection, year: int):
+def get_interfamily_violence_cases(pool: ConnectionPool, year: int, fetch=query_db):
     """
-    Query the number of interfamily violence cases that took place in each 
+    Query the number of interfamily violence cases that took place in each
     municipality for a given year
     """
+    return get_cases(pool, "interfamily_violence", year, fetch=fetch)
+
+
+def get_suicide_cases(pool: ConnectionPool, year: int, fetch=query_db):
+    """
+    Query the suicide cases for each municipality for a given year
+    """
+    return get_cases(pool, "suicides", year, fetch=fetch)
+
+
+def get_suicide_attempts(pool: ConnectionPool, year: int, fetch=query_db):
+    """
+    Query the suicide attempts for each municipality for a given year
+    """
+    return get_cases(pool, "suicide_attempts", year, fetch=fetch)
+
+
+def get_case_clusters(
+    pool: ConnectionPool,
+    case: str,
+    year: int,
+    cell_size: float,
+    bbox: Tuple[float, float, float, float] = None,
+):
+    """
+    Aggregate the cases and population of a case table for a given year into
+    square grid cells of cell_size degrees. Each cluster is placed at the mean
+    coordinates of its municipalities. Municipalities without coordinates are
+    left out and an optional (west, south, east, north) bbox restricts the
+    clusters to the municipalities inside it
+    """
+    table, _ = CASE_TABLES[case]
+    query = f"""--sql
+    SELECT
+        count(*) AS municipalities,
+        CASE WHEN count(*) = 1 THEN min(m.code) END AS municipality_code,
+        CASE WHEN count(*) = 1 THEN min(m.name) END AS municipality_name,
+        sum(c.count) AS cases,
+        sum(mph.total) AS population,
+        avg(m.latitude) AS latitude,
+        avg(m.longitude) AS longitude
+    FROM {table} c
+    JOIN municipalities m
+        ON c.municipality_id = m.code
+    JOIN municipalityPopulationHistory mph
+        ON c.municipality_id = mph.municipality_id AND c.year = mph.year
+    WHERE c.year = %(year)s
+        AND m.latitude <> 'NaN' AND m.longitude <> 'NaN'
+        AND (
+            %(west)s IS NULL
+            OR m.longitude >= %(west)s AND m.longitude < %(east)s
+            AND m.latitude >= %(south)s AND m.latitude < %(north)s
+        )
+    GROUP BY
+        floor(m.latitude / %(cell_size)s),
+        floor(m.longitude / %(cell_size)s)
+    """
+
+    west, south, east, north = bbox if bbox is not None else (None,) * 4
+    values = {
+        "year": year,
+        "cell_size": cell_size,
+        "west": west,
+        "south": south,
+        "east": east,
+        "north": north,
+    }
+    return query_db(pool, query, values)
+
+
+def get_departments_population_series(
+    pool: ConnectionPool,
+    start_year: int,
+    end_year: int,
+    department_id: int = None,
+    fetch=query_db,
+):
+    """
+    Query the population of each department, or of a single one, across a range
+    of years. Every department comes with arrays of values ordered by year
+    """
     query = """--sql
-    SELECT 
-        m.name as municipality_name,
-        m.code as municipality_code,
-        d.name as department_name,
-        d.code as department_code,
-        mph.total as population,
-        iv.count as violence_cases,
-        CASE
-            WHEN m.latitude = 'NaN' THEN NULL
-            ELSE m.latitude
-        END AS latitude,
-        CASE
-            WHEN m.longitude = 'NaN' THEN NULL
-            ELSE m.longitude
-        END AS longitude
-    FROM interfamilyViolence iv
-    JOIN municipalities m 
-        ON iv.municipality_id = m.code
-    JOIN departments d
-        ON m.department_id = d.code
-    JOIN municipalityPopulationHistory mph 
-        ON iv.municipality_id = mph.municipality_id AND iv.year = mph.year
-    WHERE iv.year = %s
+    SELECT
+        d.code as code,
+        d.name as name,
+        array_agg(dph.year ORDER BY dph.year) as years,
+        array_agg(dph.men ORDER BY dph.year) as men,
+        array_agg(dph.women ORDER BY dph.year) as women,
+        array_agg(dph.men + dph.women ORDER BY dph.year) as total
+    FROM departmentsPopulationHistory dph
+    JOIN departments d ON dph.department_id = d.code
+    WHERE dph.year BETWEEN %(start_year)s AND %(end_year)s
+        AND (%(department_id)s IS NULL OR d.code = %(department_id)s)
+    GROUP BY d.code, d.name
+    ORDER BY d.code
     """
 
-    return query_db(conn, query, [year])
+    values = {
+        "start_year": start_year,
+        "end_year": end_year,
+        "department_id": department_id,
+    }
+    return fetch(pool, query, values)
+
 
-def get_suicide_cases(conn: connection, year:int):
+def get_municipalities_population_series(
+    pool: ConnectionPool,
+    start_year: int,
+    end_year: int,
+    department_id: int = None,
+    municipality_id: int = None,
+    fetch=query_db,
+):
     """
-    Query the suicide cases for each municipality for a given year
+    Query the population of the municipalities of a department, or of a single
+    municipality, across a range of years. Every municipality comes with arrays
+    of values ordered by year
     """
     query = """--sql
-    SELECT 
+    SELECT
+        m.name as name,
+        m.code as code,
+        array_agg(mph.year ORDER BY mph.year) as years,
+        array_agg(mph.total ORDER BY mph.year) as population
+    FROM municipalities m
+    JOIN municipalityPopulationHistory mph ON m.code = mph.municipality_id
+    WHERE mph.year BETWEEN %(start_year)s AND %(end_year)s
+        AND (%(department_id)s IS NULL OR m.department_id = %(department_id)s)
+        AND (%(municipality_id)s IS NULL OR m.code = %(municipality_id)s)
+    GROUP BY m.code, m.name
+    ORDER BY m.code
+    """
+
+    values = {
+        "start_year": start_year,
+        "end_year": end_year,
+        "department_id": department_id,
+        "municipality_id": municipality_id,
+    }
+    return fetch(pool, query, values)
+
+
+def get_case_series(
+    pool: ConnectionPool,
+    case: str,
+    start_year: int,
+    end_year: int,
+    department_id: int = None,
+    municipality_id: int = None,
+    fetch=query_db,
+):
+    """
+    Query the cases of a case table for each municipality across a range of
+    years, optionally for a single department or municipality. Every
+    municipality comes with arrays of counts and population ordered by year
+    """
+    table, count_column = CASE_TABLES[case]
+    query = f"""--sql
+    SELECT
         m.name as municipality_name,
         m.code as municipality_code,
         d.name as department_name,
         d.code as department_code,
-        mph.total as population,
-        s.count as suicides,
-        CASE
-            WHEN m.latitude = 'NaN' THEN NULL
-            ELSE m.latitude
-        END AS latitude,
-        CASE
-            WHEN m.longitude = 'NaN' THEN NULL
-            ELSE m.longitude
-        END AS longitude
-    FROM suicides s
-    JOIN municipalities m 
-        ON s.municipality_id = m.code
+        array_agg(c.year ORDER BY c.year) as years,
+        array_agg(c.count ORDER BY c.year) as {count_column},
+        array_agg(mph.total ORDER BY c.year) as population
+    FROM {table} c
+    JOIN municipalities m
+        ON c.municipality_id = m.code
     JOIN departments d
         ON m.department_id = d.code
-    JOIN municipalityPopulationHistory mph 
-        ON s.municipality_id = mph.municipality_id AND s.year = mph.year
-    WHERE s.year = %s
+    JOIN municipalityPopulationHistory mph
+        ON c.municipality_id = mph.municipality_id AND c.year = mph.year
+    WHERE c.year BETWEEN %(start_year)s AND %(end_year)s
+        AND (%(department_id)s IS NULL OR m.department_id = %(department_id)s)
+        AND (%(municipality_id)s IS NULL OR m.code = %(municipality_id)s)
+    GROUP BY m.code, m.name, d.code, d.name
+    ORDER BY m.code
     """
 
-    return query_db(conn, query, [year])
+    values = {
+        "start_year": start_year,
+        "end_year": end_year,
+        "department_id": department_id,
+        "municipality_id": municipality_id,
+    }
+    return fetch(pool, query, values)
 
-def get_suicide_attempts(conn: connection, year:int):
+
+def get_case_rollup(pool: ConnectionPool, case: str, year: int):
     """
-    Query the suicide attempts for each municipality for a given year
+    Query the totals of a case table for each department and for the whole
+    country in a given year, in a single pass with grouping sets. Population
+    counts every municipality, with or without cases, so rates are per 100k
+    inhabitants of the department or country. The national row comes last
     """
-    query = """--sql
-    SELECT 
-        m.name as municipality_name,
-        m.code as municipality_code,
-        d.name as department_name,
+    table, count_column = CASE_TABLES[case]
+    query = f"""--sql
+    SELECT
         d.code as department_code,
-        mph.total as population,
-        sum(sa.count) as suicide_attempts,
-        CASE
-            WHEN m.latitude = 'NaN' THEN NULL
-            ELSE m.latitude
-        END AS latitude,
-        CASE
-            WHEN m.longitude = 'NaN' THEN NULL
-            ELSE m.longitude
-        END AS longitude
-    FROM suicideAttempts sa
+        d.name as department_name,
+        GROUPING(d.code, d.name) = 3 as national,
+        count(c.municipality_id) as municipalities,
+        coalesce(sum(c.count), 0) as {count_column},
+        sum(mph.total) as population,
+        round(
+            coalesce(sum(c.count), 0) * 100000.0 / NULLIF(sum(mph.total), 0), 2
+        ) as rate
+    FROM municipalityPopulationHistory mph
     JOIN municipalities m
-        ON sa.municipality_id = m.code
+        ON mph.municipality_id = m.code
     JOIN departments d
         ON m.department_id = d.code
-    JOIN municipalityPopulationHistory mph 
-        ON sa.municipality_id = mph.municipality_id AND sa.year = mph.year
-    WHERE sa.year = %s
-    GROUP BY
-        municipality_name,
-        municipality_code,
-        department_name,
-        department_code,
-        population
+    LEFT JOIN {table} c
+        ON c.municipality_id = mph.municipality_id AND c.year = mph.year
+    WHERE mph.year = %(year)s
+    GROUP BY GROUPING SETS ((d.code, d.name), ())
+    ORDER BY national, d.code
     """
 
-    return query_db(conn, query, [year])
+    return query_db(pool, query, {"year": year})
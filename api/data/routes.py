@@ -1,102 +1,670 @@
-from fastapi import APIRouter, Query
-from api.data.queries import (
-    conn,
+import os
+import math
+from enum import Enum
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from fastapi import APIRouter, Header, HTTPException, Path, Query, Request
+from fastapi.responses import Response, StreamingResponse
+from api.data import cases, formats, queries
+from api.data.cache import MISS, ResponseCache, http_date, is_not_modified, make_etag
+from api.data.params import page_payload, parse_fields, parse_metrics
+from api.data.queries import pool, stream_query
+from api.data.async_queries import (
     get_tables,
+    get_data_versions,
     list_departments,
     get_departments_population,
     get_municipalities_by_department,
     get_municipalities_population,
-    get_interfamily_violence_cases,
-    get_suicide_cases,
-    get_suicide_attempts,
+    get_cases,
+    get_case_clusters,
+    get_departments_population_series,
+    get_municipalities_population_series,
+    get_case_series,
+    get_case_rollup,
 )
 
 router = APIRouter()
 
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", 256))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", 3600))
+cache = ResponseCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+# data versions are reused for a few seconds, so cache hits and 304s do not
+# need a database connection. Responses may lag an ingest by this long
+DATA_VERSIONS_TTL = float(os.environ.get("DATA_VERSIONS_TTL", 5))
+versions_cache = ResponseCache(maxsize=1, ttl=DATA_VERSIONS_TTL)
+# how long clients and shared caches may reuse a response before revalidating
+# it, which is answered with 304 while the data versions are unchanged
+CACHE_MAX_AGE = int(os.environ.get("CACHE_MAX_AGE", 300))
+CACHE_CONTROL = f"public, max-age={CACHE_MAX_AGE}"
+
+# tables read by the queries, named as ingest records their data versions
+DEPARTMENT_TABLES = ["Departments", "DepartmentsPopulationHistory"]
+MUNICIPALITY_TABLES = ["Departments", "Municipalities", "MunicipalityPopulationHistory"]
+
+
+class Case(str, Enum):
+    interfamily_violence = "interfamily_violence"
+    suicides = "suicides"
+    suicide_attempts = "suicide_attempts"
+
+
+class Shape(str, Enum):
+    records = "records"
+    compact = "compact"
+
+
+CASE_VERSION_TABLES = {
+    Case.interfamily_violence: "InterfamilyViolence",
+    Case.suicides: "Suicides",
+    Case.suicide_attempts: "SuicideAttempts",
+}
+
+# clusters are grid cells of a fraction of the width of a map tile at the
+# requested zoom, so they stay about the same size on screen
+CLUSTER_CELLS_PER_TILE = int(os.environ.get("CLUSTER_CELLS_PER_TILE", 4))
+GEOJSON_MEDIA_TYPE = "application/geo+json"
+JSON_MEDIA_TYPE = formats.MEDIA_TYPES["json"]
+
+
+def json_response(
+    body: bytes, media_type: str = JSON_MEDIA_TYPE, headers: Dict[str, str] = None
+) -> Response:
+    return Response(body, media_type=media_type, headers=headers)
+
+
+def data_payload(data: List[Dict]) -> Dict:
+    return {"data": data}
+
+
+async def data_versions() -> Dict[str, Dict]:
+    versions = versions_cache.get("versions", None)
+    if versions is MISS:
+        versions = await get_data_versions(pool)
+        versions_cache.set("versions", None, versions)
+    return versions
+
+
+async def validate(
+    request: Request, tables: List[str], key: Tuple
+) -> Tuple[Tuple, Dict[str, str], bool]:
+    """
+    Look up the data versions of the tables a response is computed from and
+    derive its validators. Returns the version, the caching headers and
+    whether the conditional headers of the request match them
+    """
+    versions = await data_versions()
+    version = tuple(
+        (versions[t]["version"], versions[t]["updated_at"]) if t in versions else None
+        for t in tables
+    )
+    etag = make_etag(key, version)
+    # case endpoints negotiate their format from the Accept header
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Vary": "Accept"}
+    updated = [versions[t]["updated_at"] for t in tables if t in versions]
+    last_modified = max(updated) if updated else None
+    if last_modified is not None:
+        headers["Last-Modified"] = http_date(last_modified)
+
+    not_modified = is_not_modified(
+        request.headers.get("if-none-match"),
+        request.headers.get("if-modified-since"),
+        etag,
+        last_modified,
+    )
+    return version, headers, not_modified
+
+
+def not_modified_response(headers: Dict[str, str]) -> Response:
+    return Response(status_code=304, headers=headers)
+
+
+async def cached_response(
+    request: Request,
+    tables: List[str],
+    query,
+    *args,
+    payload: Callable[[List[Dict]], Dict] = data_payload,
+    media_type: str = JSON_MEDIA_TYPE,
+    shape: Shape = Shape.records,
+) -> Response:
+    """
+    Run a query and return its records as a json response through the response
+    cache, which keeps the encoded body. Cached responses are only served while
+    the data versions of the tables they were computed from are unchanged.
+    The payload function builds the response document from the records, given
+    as a list of dicts or, with the compact shape, as the column names and
+    lists of values. Conditional requests for an unchanged response get a 304
+    without running the query
+    """
+    key = (query.__name__, payload.__name__, shape.value) + args
+    version, headers, not_modified = await validate(request, tables, key)
+    if not_modified:
+        return not_modified_response(headers)
+
+    body = cache.get(key, version)
+    if body is MISS:
+        if shape == Shape.compact:
+            data = await query(pool, *args, fetch=queries.query_compact)
+        else:
+            data = await query(pool, *args)
+        body = formats.encode_json(payload(data))
+        cache.set(key, version, body)
+    return json_response(body, media_type, headers)
+
+
+def feature_collection(clusters: List[Dict]) -> Dict:
+    """
+    GeoJSON feature collection with a point feature per cluster
+    """
+    features = []
+    for cluster in clusters:
+        properties = dict(cluster)
+        longitude = properties.pop("longitude")
+        latitude = properties.pop("latitude")
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [longitude, latitude]},
+                "properties": properties,
+            }
+        )
+    return {"type": "FeatureCollection", "features": features}
+
+
+def rollup_payload(rows: List[Dict]) -> Dict:
+    """
+    Split the rows of a rollup query into department and national totals
+    """
+    departments, national = [], None
+    for row in rows:
+        row = dict(row)
+        if row.pop("national"):
+            del row["department_code"], row["department_name"]
+            national = row
+        else:
+            departments.append(row)
+    return {"data": {"national": national, "departments": departments}}
+
+
+def cell_size(zoom: int) -> float:
+    """
+    Size in degrees of the clustering grid cells at a given zoom level
+    """
+    return 360 / 2 ** zoom / CLUSTER_CELLS_PER_TILE
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """
+    (west, south, east, north) bounds in degrees of a web mercator tile
+    """
+    n = 2 ** z
+
+    def latitude(y):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+    return x / n * 360 - 180, latitude(y + 1), (x + 1) / n * 360 - 180, latitude(y)
+
+
+def negotiate_format(output_format: Optional[str], accept: Optional[str]) -> str:
+    fmt = formats.negotiate(output_format, accept)
+    if fmt is None:
+        raise HTTPException(
+            status_code=406,
+            detail=f"Available formats are {formats.available_formats()}",
+        )
+    return fmt
+
+
+def stream_response(
+    fmt: str, filename: str, batches: Iterator, headers: Dict[str, str] = None
+) -> StreamingResponse:
+    """
+    Response streaming records from a server side cursor in a non json format
+    """
+    headers = dict(headers or {})
+    headers["Content-Disposition"] = f'attachment; filename="{filename}.{fmt}"'
+    return StreamingResponse(
+        formats.encode(fmt, batches),
+        media_type=formats.MEDIA_TYPES[fmt],
+        headers=headers,
+    )
+
+
+FORMAT_QUERY = Query(
+    None, alias="format", title="Output format: json, csv, arrow or parquet"
+)
+START_YEAR_QUERY = Query(2016, title="First year of the series", ge=2016, le=2022)
+END_YEAR_QUERY = Query(2022, title="Last year of the series", ge=2016, le=2022)
+METRICS_QUERY = Query(
+    None,
+    title="Comma separated metrics: " + ", ".join(cases.CASE_METRICS),
+)
+BUCKETS_QUERY = Query(
+    cases.PERCENTILE_BUCKETS, title="Number of percentile buckets", ge=2, le=100
+)
+FIELDS_QUERY = Query(
+    None, title="Comma separated columns and metrics to return, by default all"
+)
+DEPARTMENT_QUERY = Query(None, title="Only municipalities of this department")
+AFTER_QUERY = Query(None, title="Only municipalities with a greater code")
+LIMIT_QUERY = Query(None, title="Maximum number of records", ge=1, le=2000)
+SHAPE_QUERY = Query(
+    Shape.records,
+    title="records, a list of objects, or compact, column names and lists of values",
+)
+
+
+async def case_response(
+    request: Request,
+    case: Case,
+    year: int,
+    metrics: Optional[str],
+    buckets: int,
+    fields: Optional[str],
+    department_id: Optional[int],
+    after: Optional[int],
+    limit: Optional[int],
+    output_format: Optional[str],
+    accept: Optional[str],
+    shape: Shape,
+) -> Response:
+    """
+    Response with the cases of every municipality for a year, streamed in the
+    negotiated format or else as cached json. Json pages include the cursor of
+    the next page, streamed pages end when fewer than limit records are returned
+    """
+    fmt = negotiate_format(output_format, accept)
+    fields, metrics = parse_fields(case.value, fields, parse_metrics(metrics))
+    if "percentile" not in metrics:
+        buckets = cases.PERCENTILE_BUCKETS  # does not change the response
+    tables = MUNICIPALITY_TABLES + [CASE_VERSION_TABLES[case]]
+    if fmt != "json":
+        args = (case.value, year, metrics, buckets, fields, department_id, after, limit)
+        _, headers, not_modified = await validate(request, tables, (fmt,) + args)
+        if not_modified:
+            return not_modified_response(headers)
+        batches = queries.get_cases(pool, *args, fetch=stream_query)
+        return stream_response(fmt, f"{case.value}_{year}", batches, headers)
+
+    if limit is None:
+        payload = data_payload
+    else:
+        payload = page_payload(limit)
+        limit += 1
+    return await cached_response(
+        request,
+        tables,
+        get_cases,
+        case.value,
+        year,
+        metrics,
+        buckets,
+        fields,
+        department_id,
+        after,
+        limit,
+        payload=payload,
+        shape=shape,
+    )
+
+
+def check_year_range(start_year: int, end_year: int):
+    if start_year > end_year:
+        raise HTTPException(
+            status_code=422, detail="start_year must not be after end_year"
+        )
+
 
 @router.get("/", tags=["root"])
 async def root():
     """
     Development endpoint. Returns list of public tables in the database
     """
-    return {"tables": get_tables(conn)}
+    return json_response(formats.encode_json({"tables": await get_tables(pool)}))
 
 
 @router.get("/departments", tags=["departments"])
-async def departments():
+async def departments(request: Request, shape: Shape = SHAPE_QUERY):
     """
     Returns a list of departments
     """
-    return {"data": list_departments(conn)}
+    return await cached_response(
+        request, ["Departments"], list_departments, shape=shape
+    )
 
 
 @router.get("/departments_population", tags=["departments"])
 async def departments_population(
+    request: Request,
     year: int = Query(
         title="The year to get departmets population from", ge=2016, le=2022
-    )
+    ),
+    shape: Shape = SHAPE_QUERY,
 ):
     """
     Returns population of every department for a given year
     """
-    return {"data": get_departments_population(conn, year)}
+    return await cached_response(
+        request, DEPARTMENT_TABLES, get_departments_population, year, shape=shape
+    )
+
+
+@router.get("/departments_population/series", tags=["departments"])
+async def departments_population_series(
+    request: Request,
+    start_year: int = START_YEAR_QUERY,
+    end_year: int = END_YEAR_QUERY,
+    department_id: Optional[int] = Query(None, title="Department code"),
+    shape: Shape = SHAPE_QUERY,
+):
+    """
+    Returns the population of every department, or of a single one, for a range
+    of years. Each department has arrays of years, men, women and totals
+    """
+    check_year_range(start_year, end_year)
+    return await cached_response(
+        request,
+        DEPARTMENT_TABLES,
+        get_departments_population_series,
+        start_year,
+        end_year,
+        department_id,
+        shape=shape,
+    )
 
 
 @router.get("/municipalities", tags=["municipalities"])
-async def municipalities(department_id: int = Query(title="Department code")):
+async def municipalities(
+    request: Request,
+    department_id: int = Query(title="Department code"),
+    shape: Shape = SHAPE_QUERY,
+):
     """
     Return a list of municipalities belonging to a given department
     """
-    return {"data": get_municipalities_by_department(conn, department_id)}
+    return await cached_response(
+        request,
+        MUNICIPALITY_TABLES,
+        get_municipalities_by_department,
+        department_id,
+        shape=shape,
+    )
 
 
 @router.get("/municipalities_population", tags=["municipalities"])
 async def municipalities_population(
+    request: Request,
     department_id: int = Query(title="Department code"),
     year: int = Query(
         title="The year to get departmets population from", ge=2016, le=2022
     ),
+    shape: Shape = SHAPE_QUERY,
 ):
     """
     Returns the population of the municipalities in a department for a given year
     """
-    return {"data": get_municipalities_population(conn, department_id, year)}
+    return await cached_response(
+        request,
+        MUNICIPALITY_TABLES,
+        get_municipalities_population,
+        department_id,
+        year,
+        shape=shape,
+    )
+
+
+@router.get("/municipalities_population/series", tags=["municipalities"])
+async def municipalities_population_series(
+    request: Request,
+    start_year: int = START_YEAR_QUERY,
+    end_year: int = END_YEAR_QUERY,
+    department_id: Optional[int] = Query(None, title="Department code"),
+    municipality_id: Optional[int] = Query(None, title="Municipality code"),
+    shape: Shape = SHAPE_QUERY,
+):
+    """
+    Returns the population of the municipalities, optionally those of a
+    department or a single one, for a range of years. Each municipality has
+    arrays of years and population
+    """
+    check_year_range(start_year, end_year)
+    return await cached_response(
+        request,
+        MUNICIPALITY_TABLES,
+        get_municipalities_population_series,
+        start_year,
+        end_year,
+        department_id,
+        municipality_id,
+        shape=shape,
+    )
 
 
 @router.get("/interfamily_violence", tags=["cases"])
 async def iterfamily_violence(
+    request: Request,
     year: int = Query(
         title="The year to get departmets population from", ge=2016, le=2022
-    )
+    ),
+    metrics: Optional[str] = METRICS_QUERY,
+    buckets: int = BUCKETS_QUERY,
+    fields: Optional[str] = FIELDS_QUERY,
+    department_id: Optional[int] = DEPARTMENT_QUERY,
+    after: Optional[int] = AFTER_QUERY,
+    limit: Optional[int] = LIMIT_QUERY,
+    output_format: Optional[str] = FORMAT_QUERY,
+    accept: Optional[str] = Header(None),
+    shape: Shape = SHAPE_QUERY,
 ):
     """
     Return the number of interfamily cases per municipality for a given year.
-    Records also include population for that year and municipality coordinates
+    Records also include population for that year and municipality coordinates.
+    Rates per 100k inhabitants, in department and national ranks and percentile
+    buckets are added through the metrics parameter.
+    Records can be restricted to a department, trimmed to some fields and
+    paginated by municipality code with after and limit.
+    Also available as csv, arrow or parquet through the format parameter or
+    the Accept header
     """
-    return {"data": get_interfamily_violence_cases(conn, year)}
+    return await case_response(
+        request,
+        Case.interfamily_violence,
+        year,
+        metrics,
+        buckets,
+        fields,
+        department_id,
+        after,
+        limit,
+        output_format,
+        accept,
+        shape,
+    )
 
 
 @router.get("/suicides", tags=["cases"])
 async def suicides(
+    request: Request,
     year: int = Query(
         title="The year to get departmets population from", ge=2016, le=2022
-    )
+    ),
+    metrics: Optional[str] = METRICS_QUERY,
+    buckets: int = BUCKETS_QUERY,
+    fields: Optional[str] = FIELDS_QUERY,
+    department_id: Optional[int] = DEPARTMENT_QUERY,
+    after: Optional[int] = AFTER_QUERY,
+    limit: Optional[int] = LIMIT_QUERY,
+    output_format: Optional[str] = FORMAT_QUERY,
+    accept: Optional[str] = Header(None),
+    shape: Shape = SHAPE_QUERY,
 ):
     """
     Return the number of suicide cases per municipality for a given year.
-    Records also include population for that year and municipality coordinates
+    Records also include population for that year and municipality coordinates.
+    Rates per 100k inhabitants, in department and national ranks and percentile
+    buckets are added through the metrics parameter.
+    Records can be restricted to a department, trimmed to some fields and
+    paginated by municipality code with after and limit.
+    Also available as csv, arrow or parquet through the format parameter or
+    the Accept header
     """
-    return {"data": get_suicide_cases(conn, year)}
+    return await case_response(
+        request,
+        Case.suicides,
+        year,
+        metrics,
+        buckets,
+        fields,
+        department_id,
+        after,
+        limit,
+        output_format,
+        accept,
+        shape,
+    )
 
 
 @router.get("/suicide_attempts", tags=["cases"])
 async def suicide_attempts(
+    request: Request,
     year: int = Query(
         title="The year to get departmets population from", ge=2016, le=2022
-    )
+    ),
+    metrics: Optional[str] = METRICS_QUERY,
+    buckets: int = BUCKETS_QUERY,
+    fields: Optional[str] = FIELDS_QUERY,
+    department_id: Optional[int] = DEPARTMENT_QUERY,
+    after: Optional[int] = AFTER_QUERY,
+    limit: Optional[int] = LIMIT_QUERY,
+    output_format: Optional[str] = FORMAT_QUERY,
+    accept: Optional[str] = Header(None),
+    shape: Shape = SHAPE_QUERY,
 ):
     """
     Return the number of suicide attempts per municipality for a given year.
-    Records also include population for that year and municipality coordinates
+    Records also include population for that year and municipality coordinates.
+    Rates per 100k inhabitants, in department and national ranks and percentile
+    buckets are added through the metrics parameter.
+    Records can be restricted to a department, trimmed to some fields and
+    paginated by municipality code with after and limit.
+    Also available as csv, arrow or parquet through the format parameter or
+    the Accept header
+    """
+    return await case_response(
+        request,
+        Case.suicide_attempts,
+        year,
+        metrics,
+        buckets,
+        fields,
+        department_id,
+        after,
+        limit,
+        output_format,
+        accept,
+        shape,
+    )
+
+
+@router.get("/series/{case}", tags=["cases"])
+async def case_series(
+    request: Request,
+    case: Case,
+    start_year: int = START_YEAR_QUERY,
+    end_year: int = END_YEAR_QUERY,
+    department_id: Optional[int] = Query(None, title="Department code"),
+    municipality_id: Optional[int] = Query(None, title="Municipality code"),
+    shape: Shape = SHAPE_QUERY,
+):
+    """
+    Return the cases per municipality for a range of years, optionally for the
+    municipalities of a department or a single one. Each municipality has
+    arrays of years, cases and population in a single record
+    """
+    check_year_range(start_year, end_year)
+    return await cached_response(
+        request,
+        MUNICIPALITY_TABLES + [CASE_VERSION_TABLES[case]],
+        get_case_series,
+        case.value,
+        start_year,
+        end_year,
+        department_id,
+        municipality_id,
+        shape=shape,
+    )
+
+
+@router.get("/rollup/{case}", tags=["cases"])
+async def case_rollup(
+    request: Request,
+    case: Case,
+    year: int = Query(title="The year to get the cases from", ge=2016, le=2022),
+):
+    """
+    Return the cases, population and rate per 100k inhabitants of every
+    department and of the whole country for a given year
     """
-    return {"data": get_suicide_attempts(conn, year)}
+    return await cached_response(
+        request,
+        MUNICIPALITY_TABLES + [CASE_VERSION_TABLES[case]],
+        get_case_rollup,
+        case.value,
+        year,
+        payload=rollup_payload,
+    )
+
+
+@router.get("/geojson/{case}", tags=["maps"])
+async def case_clusters(
+    request: Request,
+    case: Case,
+    year: int = Query(title="The year to get the cases from", ge=2016, le=2022),
+    zoom: int = Query(
+        5, title="Map zoom level the clusters are sized for", ge=0, le=18
+    ),
+):
+    """
+    Return the cases and population of a year aggregated into grid cells sized
+    for a map zoom level, as a GeoJSON feature collection of points.
+    Single municipality clusters also include the municipality code and name
+    """
+    return await cached_response(
+        request,
+        MUNICIPALITY_TABLES + [CASE_VERSION_TABLES[case]],
+        get_case_clusters,
+        case.value,
+        year,
+        cell_size(zoom),
+        payload=feature_collection,
+        media_type=GEOJSON_MEDIA_TYPE,
+    )
+
+
+@router.get("/tiles/{case}/{z}/{x}/{y}.geojson", tags=["maps"])
+async def case_tile(
+    request: Request,
+    case: Case,
+    z: int = Path(title="Zoom level", ge=0, le=18),
+    x: int = Path(title="Tile column", ge=0),
+    y: int = Path(title="Tile row", ge=0),
+    year: int = Query(title="The year to get the cases from", ge=2016, le=2022),
+):
+    """
+    Return the clusters of a web mercator tile, as in /geojson/{case} for the
+    zoom level of the tile. Only municipalities inside the tile are aggregated
+    """
+    if x >= 2 ** z or y >= 2 ** z:
+        raise HTTPException(status_code=404, detail=f"Tile {z}/{x}/{y} does not exist")
+
+    return await cached_response(
+        request,
+        MUNICIPALITY_TABLES + [CASE_VERSION_TABLES[case]],
+        get_case_clusters,
+        case.value,
+        year,
+        cell_size(z),
+        tile_bounds(z, x, y),
+        payload=feature_collection,
+        media_type=GEOJSON_MEDIA_TYPE,
+    )
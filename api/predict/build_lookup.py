@@ -0,0 +1,98 @@
+import os
+import sys
+import csv
+import json
+import itertools
+import numpy as np
+from typing import List, Tuple
+from utils import lookup_paths, model_key, object_etag, score_probs, templates
+
+CHUNK_SIZE = 50_000  # records scored per model call
+# department and municipality names of every municipality, as sent to the model
+MUNICIPALITIES_CSV = os.environ.get(
+    "MUNICIPALITIES_CSV",
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)),
+        "..",
+        "..",
+        "csv_data",
+        "municipalities_lat_lon.csv",
+    ),
+)
+
+
+def template_values(columns: List[str], variable: str) -> List[str]:
+    """
+    Values of a variable one hot encoded in the template columns
+    """
+    prefix = f"{variable}_"
+    return [column[len(prefix) :] for column in columns if column.startswith(prefix)]
+
+
+def load_municipalities(path: str = MUNICIPALITIES_CSV) -> List[Tuple[str, str]]:
+    """
+    Read the (department, municipality) pairs that exist
+    """
+    with open(path, newline="", encoding="utf-8") as f:
+        return sorted({(row["DPTO"], row["MUNICIPIO"]) for row in csv.DictReader(f)})
+
+
+def build_lookup(var_name: str, model_name: str = "brm", chunk_size: int = CHUNK_SIZE):
+    """
+    Score every combination of municipality, gender and variable value in the
+    model template and store the probabilities as a memory mappable array,
+    along with the vocabulary of each axis and the ETag of the model they were
+    computed from. Only municipalities paired with their own department are
+    enumerated
+    """
+    etag = object_etag(model_key(var_name))
+    template = templates.get(var_name, model_name)
+    departments = set(template_values(template.columns, "DPTO"))
+    municipios = set(template_values(template.columns, "MUNICIPIO"))
+    vocab = {
+        "etag": etag,
+        "municipalities": [
+            [dpto, municipio]
+            for dpto, municipio in load_municipalities()
+            if dpto in departments and municipio in municipios
+        ],
+        "genders": template_values(template.columns, "GENDER"),
+        "values": template_values(template.columns, var_name),
+    }
+    shape = (len(vocab["municipalities"]), len(vocab["genders"]), len(vocab["values"]))
+    print(f"Building {var_name} lookup table of shape {shape}")
+
+    probs_path, vocab_path = lookup_paths(var_name, model_name)
+    os.makedirs(os.path.dirname(probs_path), exist_ok=True)
+    probs = np.lib.format.open_memmap(
+        probs_path, mode="w+", dtype=np.float32, shape=shape
+    )
+    flat_probs = probs.reshape(-1)
+
+    combinations = (
+        (dpto, municipio, gender, value)
+        for (dpto, municipio), gender, value in itertools.product(
+            vocab["municipalities"], vocab["genders"], vocab["values"]
+        )
+    )
+    for start in range(0, flat_probs.size, chunk_size):
+        records = list(itertools.islice(combinations, chunk_size))
+        flat_probs[start : start + len(records)] = score_probs(
+            var_name, records, model_name
+        )
+    probs.flush()
+
+    with open(vocab_path, "w") as f:
+        json.dump(vocab, f, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        var_names = sys.argv[1:]
+    else:
+        from routes import VAR_NAMES
+
+        var_names = [var.upper() for var in VAR_NAMES]
+
+    for var_name in var_names:
+        build_lookup(var_name)
@@ -1,11 +1,34 @@
+import os
 from fastapi import FastAPI
 from mangum import Mangum
-from routes import router as predict_router
+from routes import router as predict_router, VAR_NAMES
+from utils import ready, start_preload
 import uvicorn
 
+PRELOAD_MODELS = os.environ.get("PRELOAD_MODELS", "false").lower() == "true"
+PRELOAD_VARS = [var.upper() for var in VAR_NAMES]
+
 app = FastAPI(docs_url="/predict/docs", openapi_url="/predict/openapi.json")
 app.include_router(predict_router, prefix="/predict")
 
+
+@app.on_event("startup")
+def startup():
+    """
+    Start loading every model and template in the background when preloading
+    is enabled, if it was not started already. Otherwise they are loaded lazily
+    and the service is ready
+    """
+    if PRELOAD_MODELS:
+        start_preload(PRELOAD_VARS)
+    else:
+        ready.set()
+
+
+# also run it on import, so preloading starts during the lambda init phase
+# instead of waiting for mangum to run the startup event
+startup()
+
 handler = Mangum(app)
 
 if __name__ == "__main__":
@@ -1,7 +1,10 @@
+import os
 from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
-from typing import Union
-from utils import compute_prob
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Union
+import utils
+from utils import UnknownValueError, compute_prob, compute_probs, ready
 from unidecode import unidecode
 
 router = APIRouter()
@@ -14,6 +17,14 @@ VAR_NAMES = [
     "vulnerability_factor",
 ]
 
+# variables of a request are scored concurrently on this pool
+SCORING_WORKERS = int(os.environ.get("SCORING_WORKERS", len(VAR_NAMES)))
+executor = ThreadPoolExecutor(max_workers=SCORING_WORKERS)
+# records accepted by a single batch request, enough for a municipality by
+# gender by value grid. Most are answered from the lookup tables and the rest
+# are scored in vectorized model calls
+MAX_BATCH_RECORDS = int(os.environ.get("MAX_BATCH_RECORDS", 50000))
+
 
 class ModelInput(BaseModel):
     department: str
@@ -26,6 +37,25 @@ class ModelInput(BaseModel):
     vulnerability_factor: Union[str, None] = None
 
 
+class BatchInput(BaseModel):
+    records: List[ModelInput]
+
+
+@router.get("/ready")
+def readiness():
+    """
+    Readiness probe. Fails with 503 while models are still being preloaded and
+    with 500 if preloading failed
+    """
+    if utils.preload_error is not None:
+        raise HTTPException(
+            status_code=500, detail=f"Preloading failed: {utils.preload_error!r}"
+        )
+    if not ready.is_set():
+        raise HTTPException(status_code=503, detail="Models are still loading")
+    return {"ready": True}
+
+
 @router.post("/")
 def predict(record: ModelInput):
     """
@@ -37,17 +67,15 @@ def predict(record: ModelInput):
     municipality = unidecode(record.municipality.upper())
     gender = record.gender.upper()
 
+    futures = {
+        var: executor.submit(
+            compute_prob, department, municipality, gender, var.upper(), record_dict[var]
+        )
+        for var in VAR_NAMES
+        if record_dict.get(var) is not None
+    }
     try:
-        probs = [
-            {
-                "var": var,
-                "prob": compute_prob(
-                    department, municipality, gender, var.upper(), record_dict[var]
-                ),
-            }
-            for var in VAR_NAMES
-            if record_dict.get(var) is not None
-        ]
+        probs = [{"var": var, "prob": future.result()} for var, future in futures.items()]
     except ValueError as e:
         raise HTTPException(status_code=422, detail=str(e))
 
@@ -59,3 +87,64 @@ def predict(record: ModelInput):
     global_prob = sum([p["prob"] for p in probs]) / len(probs)
 
     return {"probabilities": probs, "global": global_prob}
+
+
+@router.post("/batch")
+def predict_batch(batch: BatchInput):
+    """
+    Score many records at once. Records are grouped by variable and every group
+    is scored with a single model call. Returns the same predictions as the
+    single record endpoint, one per record and in the same order. Batches
+    larger than MAX_BATCH_RECORDS are rejected with 413
+    """
+    if len(batch.records) > MAX_BATCH_RECORDS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {MAX_BATCH_RECORDS} records can be scored at once",
+        )
+
+    groups = {var: ([], []) for var in VAR_NAMES}
+    for i, record in enumerate(batch.records):
+        record_dict = record.dict()
+        department = unidecode(record.department.upper())
+        municipality = unidecode(record.municipality.upper())
+        gender = record.gender.upper()
+
+        variables = [var for var in VAR_NAMES if record_dict.get(var) is not None]
+        if not variables:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Record {i}: at least one of {VAR_NAMES} must be specified",
+            )
+        for var in variables:
+            positions, records = groups[var]
+            positions.append(i)
+            records.append((department, municipality, gender, record_dict[var]))
+
+    futures = {
+        var: executor.submit(compute_probs, var.upper(), records)
+        for var, (_, records) in groups.items()
+        if records
+    }
+    probs = [[] for _ in batch.records]
+    try:
+        for var, future in futures.items():
+            positions = groups[var][0]
+            for i, prob in zip(positions, future.result()):
+                probs[i].append({"var": var, "prob": float(prob)})
+    except UnknownValueError as e:
+        raise HTTPException(
+            status_code=422, detail=f"Record {positions[e.record]}: {e}"
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+    predictions = [
+        {
+            "probabilities": record_probs,
+            "global": sum([p["prob"] for p in record_probs]) / len(record_probs),
+        }
+        for record_probs in probs
+    ]
+
+    return {"predictions": predictions}
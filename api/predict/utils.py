@@ -1,9 +1,14 @@
 import os
+import csv
+import json
 import boto3
 import joblib
+import tempfile
+import threading
 import numpy as np
-import pandas as pd
-from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Tuple
 from scipy.special import erf
 
 
@@ -13,27 +18,248 @@ BUCKET = "ds4a-co6-t107-datalake"
 aws = boto3.Session()
 s3 = aws.client("s3")
 models = {}  # init empty, lazy loading of models
+model_locks: Dict[str, threading.Lock] = {}
+ready = threading.Event()  # set once preloading finishes
+preload_error: Optional[BaseException] = None  # set if preloading failed
+preload_lock = threading.Lock()
+preload_thread: Optional[threading.Thread] = None
+ARTIFACT_CACHE_DIR = os.environ.get("ARTIFACT_CACHE_DIR", "/tmp/artifacts")
+PRELOAD_WORKERS = int(os.environ.get("PRELOAD_WORKERS", 8))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+TEMPLATE_ROWS = 10  # rows of the template scored along with the record
+TEMPLATE_CACHE_SIZE = int(os.environ.get("TEMPLATE_CACHE_SIZE", 16))
+LOOKUP_DIR = os.environ.get(
+    "LOOKUP_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "lookup")
+)
 
 # load functions
 
 
+def download_cached(key: str) -> str:
+    """
+    Download an object to the local artifact cache and return its path. The
+    download is skipped when the cached copy has the same ETag as the object,
+    so warm containers reuse what previous runs already fetched
+    """
+    path = os.path.join(ARTIFACT_CACHE_DIR, key)
+    etag_path = f"{path}.etag"
+    etag = s3.head_object(Bucket=BUCKET, Key=key)["ETag"]
+
+    if os.path.exists(path) and os.path.exists(etag_path):
+        with open(etag_path) as f:
+            if f.read() == etag:
+                return path
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(fd)
+    try:
+        # IfMatch fails the download if the object changed since head_object,
+        # so the stored ETag always describes the cached content
+        body = s3.get_object(Bucket=BUCKET, Key=key, IfMatch=etag)["Body"]
+        with open(tmp_path, "wb") as f:
+            for chunk in body.iter_chunks(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    with open(etag_path, "w") as f:
+        f.write(etag)
+    return path
+
+
+def model_key(var: str) -> str:
+    return f"assets/models/{var}-brm.joblib"
+
+
+def object_etag(key: str) -> str:
+    return s3.head_object(Bucket=BUCKET, Key=key)["ETag"]
+
+
 def load_model(var: str):
-    key = f"assets/models/{var}-brm.joblib"
-    with BytesIO() as f:
-        s3.download_fileobj(Bucket=BUCKET, Key=key, Fileobj=f)
-        f.seek(0)
-        model = joblib.load(f)
-    return model
+    return joblib.load(download_cached(model_key(var)))
+
+
+def get_model(var_name: str):
+    """
+    Return the model of a variable, loading it on first use. Concurrent callers
+    wait for a load in progress instead of downloading the model again
+    """
+    if var_name not in models:
+        with model_locks.setdefault(var_name, threading.Lock()):
+            if var_name not in models:
+                models[var_name] = load_model(var_name)
+    return models[var_name]
+
+
+def load_csv_header(key: str, max_rows: int):
+    """
+    Read the column names of a csv file and count its rows up to max_rows
+    """
+    with open(download_cached(key), newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        n_rows = sum(1 for _ in zip(range(max_rows), reader))
+    return columns, n_rows
+
+
+# template cache
+
+
+class Template(NamedTuple):
+    """
+    Compact representation of a feature template: the column names, a map from
+    column name to its position and a zero vector with the template width
+    """
+
+    columns: List[str]
+    index: Dict[str, int]
+    zeros: np.ndarray
+    n_rows: int
 
 
-def load_df(key: str):
-    obj = s3.get_object(Bucket=BUCKET, Key=key).get("Body")
-    return pd.read_csv(obj)
+class TemplateCache:
+    """
+    Size bounded LRU cache of feature templates, so each template is downloaded
+    from S3 and parsed only once per container
+    """
+
+    def __init__(self, maxsize: int = TEMPLATE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._templates: "OrderedDict[str, Template]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, var_name: str, model_name: str = "brm") -> Template:
+        key = f"{var_name}_{model_name}"
+        with self._lock:
+            if key in self._templates:
+                self._templates.move_to_end(key)
+                return self._templates[key]
+
+        columns, n_rows = load_csv_header(
+            f"assets/templates/{key}_TEMPLATE.csv", TEMPLATE_ROWS
+        )
+        template = Template(
+            columns=columns,
+            index={column: i for i, column in enumerate(columns)},
+            zeros=np.zeros(len(columns)),
+            n_rows=max(n_rows, 1),
+        )
+
+        with self._lock:
+            self._templates[key] = template
+            self._templates.move_to_end(key)
+            while len(self._templates) > self.maxsize:
+                self._templates.popitem(last=False)
+        return template
+
+    def refresh(self, var_name: Optional[str] = None, model_name: str = "brm"):
+        """
+        Drop a cached template, or every template if no variable is given, so
+        that it is downloaded again on next use
+        """
+        with self._lock:
+            if var_name is None:
+                self._templates.clear()
+            else:
+                self._templates.pop(f"{var_name}_{model_name}", None)
+
+
+templates = TemplateCache()
+
+
+# lookup tables
+
+
+class LookupTable(NamedTuple):
+    """
+    Precomputed probabilities of every valid combination of the categorical
+    inputs of a model. probs is indexed by (municipality, gender, var_value)
+    using the positions stored in the vocabularies, where municipalities are
+    (dpto, municipio) pairs since municipality names repeat across departments
+    """
+
+    municipalities: Dict[Tuple[str, str], int]
+    genders: Dict[str, int]
+    values: Dict[str, int]
+    probs: np.ndarray
+
+
+lookup_tables: Dict[str, Optional[LookupTable]] = {}
+padding_scores: Dict[str, float] = {}
+
+
+def lookup_paths(var_name: str, model_name: str = "brm"):
+    """
+    Paths of the probabilities array and the vocabularies of a lookup table
+    """
+    prefix = os.path.join(LOOKUP_DIR, f"{var_name}_{model_name}_LOOKUP")
+    return f"{prefix}.npy", f"{prefix}.json"
+
+
+def load_lookup(var_name: str, model_name: str = "brm") -> Optional[LookupTable]:
+    """
+    Memory map the lookup table of a model. Returns None if it was not built or
+    if it was built from a different version of the model than the one in S3
+    """
+    key = f"{var_name}_{model_name}"
+    if key not in lookup_tables:
+        probs_path, vocab_path = lookup_paths(var_name, model_name)
+        table = None
+        if os.path.exists(probs_path) and os.path.exists(vocab_path):
+            with open(vocab_path) as f:
+                vocab = json.load(f)
+            if vocab.get("etag") == object_etag(model_key(var_name)):
+                table = LookupTable(
+                    municipalities={
+                        tuple(pair): i for i, pair in enumerate(vocab["municipalities"])
+                    },
+                    genders={value: i for i, value in enumerate(vocab["genders"])},
+                    values={value: i for i, value in enumerate(vocab["values"])},
+                    probs=np.load(probs_path, mmap_mode="r"),
+                )
+            else:
+                print(f"Lookup table {key} is stale, scoring with the model")
+        lookup_tables[key] = table
+    return lookup_tables[key]
+
+
+def lookup_probs(var_name, records, model_name="brm"):
+    """
+    Look up the probabilities of a batch of (dpto, municipio, gender, var_value)
+    records. Records missing from the table get NaN
+    """
+    probs = np.full(len(records), np.nan)
+    table = load_lookup(var_name, model_name)
+    if table is None:
+        return probs
+
+    for i, (dpto, municipio, gender, var_value) in enumerate(records):
+        position = (
+            table.municipalities.get((dpto, municipio)),
+            table.genders.get(gender),
+            table.values.get(var_value),
+        )
+        if None not in position:
+            probs[i] = table.probs[position]
+    return probs
 
 
 # prediction functions
 
 
+class UnknownValueError(ValueError):
+    """
+    Raised when a record has a value the model was not trained on. record is
+    the position of the offending record in the scored batch
+    """
+
+    def __init__(self, message: str, record: int = 0):
+        super().__init__(message)
+        self.record = record
+
+
 def compute_probs_from_scores(scores):
     if len(scores) == 1:
         XMIN = np.sqrt(2) / 2
@@ -59,38 +285,161 @@ def compute_prob(dpto, municipio, gender, var_name, var_value, model_name="brm")
     Usage examples:
     VAR_NAME="CAUSE"
     MODEL_NAME="brm"
-    model = load_model(f"OUTPUT/{VAR_NAME}-{MODEL_NAME}.pickle")
-    print(compute_prob("BOGOTA", "BOGOTA", "MASCULINO", VAR_NAME, "Desamor", model, MODEL_NAME))
-    print(compute_prob("ANTIOQUIA", "MEDELLIN", "MASCULINO", VAR_NAME, "Bullying", model, MODEL_NAME))
-    print(compute_prob("CAUCA", "SUAREZ", "MASCULINO", VAR_NAME, "Acceso a armas de fuego", model, MODEL_NAME))
+    print(compute_prob("BOGOTA", "BOGOTA", "MASCULINO", VAR_NAME, "Desamor", MODEL_NAME))
+    print(compute_prob("ANTIOQUIA", "MEDELLIN", "MASCULINO", VAR_NAME, "Bullying", MODEL_NAME))
+    print(compute_prob("CAUCA", "SUAREZ", "MASCULINO", VAR_NAME, "Acceso a armas de fuego", MODEL_NAME))
     """
-    # load template dataframe with right colnames and zero values
-    df = load_df(f"assets/templates/{var_name}_{model_name}_TEMPLATE.csv").head(10)
+    records = [(dpto, municipio, gender, var_value)]
+    return compute_probs(var_name, records, model_name)[0]
 
-    if var_name not in models:
-        models[var_name] = load_model(var_name)
-
-    model = models[var_name]
-    # Setup 1 on dpto municipio gender var_name var_value
-    record_features = [
-        f"DPTO_{dpto}",
-        f"MUNICIPIO_{municipio}",
-        f"GENDER_{gender}",
-        f"{var_name}_{var_value}",
-    ]
-
-    for feature in record_features:
-        if feature not in df.columns:
-            variable, value = feature.split("_")
-            raise ValueError(f"{value=} for {variable=} not considered in the model")
-
-    df.loc[0, record_features] = 1
-
-    # compute the probability
-    prob = -1.0
+
+def compute_probs_from_score_rows(scores):
+    """
+    Row-wise version of compute_probs_from_scores. Each row holds the scores of
+    a record followed by the scores of the template padding rows, and the
+    probability of the record (first column) is returned for every row
+    """
+    if scores.shape[1] == 1:
+        XMIN = np.sqrt(2) / 2
+        XMAX = 1.0
+        return ((scores[:, 0] - XMIN) / (XMAX - XMIN)).clip(0, 1.0)
+    std = np.std(scores, axis=1)
+    mean = np.mean(scores, axis=1)
+    spread = std > 0.0
+    pre_erf_scores = scores[:, 0] / np.sqrt(2)
+    pre_erf_scores[spread] = (scores[spread, 0] - mean[spread]) / (
+        std[spread] * np.sqrt(2)
+    )
+    return erf(pre_erf_scores).clip(0, 1.0)
+
+
+def compute_probs(var_name, records, model_name="brm"):
+    """
+    Vectorized version of compute_prob for a batch of records of the same
+    variable. Each record is a (dpto, municipio, gender, var_value) tuple.
+
+    Probabilities are taken from the precomputed lookup table and only the
+    records missing from it are scored
+    """
+    probs = lookup_probs(var_name, records, model_name)
+    misses = np.flatnonzero(np.isnan(probs))
+    if len(misses):
+        try:
+            probs[misses] = score_probs(
+                var_name, [records[i] for i in misses], model_name
+            )
+        except UnknownValueError as e:
+            raise UnknownValueError(str(e), int(misses[e.record])) from e
+    return probs
+
+
+def score_probs(var_name, records, model_name="brm"):
+    """
+    Score a batch of (dpto, municipio, gender, var_value) records of the same
+    variable with the model.
+
+    The feature matrix of the whole batch is scored with a single model call.
+    Template padding rows are all zeros, so their score is cached and only the
+    record rows are scored.
+    """
+    template = templates.get(var_name, model_name)
+    model = get_model(var_name)
+
+    # Setup 1 on dpto municipio gender var_name var_value of each record
+    features = np.tile(template.zeros, (len(records), 1))
+    for i, (dpto, municipio, gender, var_value) in enumerate(records):
+        for variable, value in [
+            ("DPTO", dpto),
+            ("MUNICIPIO", municipio),
+            ("GENDER", gender),
+            (var_name, var_value),
+        ]:
+            position = template.index.get(f"{variable}_{value}")
+            if position is None:
+                raise UnknownValueError(
+                    f"{value=} for {variable=} not considered in the model", i
+                )
+            features[i, position] = 1
+
+    probs = np.full(len(records), -1.0)
     if model_name == "brm":
-        decision_scores = np.array(model.score_samples(df))
         threshold = 0.98
-        decision_scores[decision_scores >= threshold] = 1.8
-        prob = compute_probs_from_scores(decision_scores)
-    return prob[0]
+        scores = np.empty((len(records), template.n_rows))
+        scores[:, 0] = model.score_samples(features)
+        if template.n_rows > 1:
+            scores[:, 1:] = padding_score(var_name, model_name)
+        scores[scores >= threshold] = 1.8
+        probs = compute_probs_from_score_rows(scores)
+    return probs
+
+
+def padding_score(var_name, model_name="brm"):
+    """
+    Score of the all-zero template padding rows. It does not depend on the
+    record, so it is computed once per model
+    """
+    key = f"{var_name}_{model_name}"
+    if key not in padding_scores:
+        template = templates.get(var_name, model_name)
+        padding_scores[key] = get_model(var_name).score_samples(
+            template.zeros.reshape(1, -1)
+        )[0]
+    return padding_scores[key]
+
+
+def refresh(var_name: Optional[str] = None, model_name: str = "brm"):
+    """
+    Drop the cached models, templates, lookup tables and padding scores of a
+    variable, or of every variable if none is given, so they are loaded again
+    on next use. Artifacts on disk are kept and revalidated by ETag
+    """
+    templates.refresh(var_name, model_name)
+    if var_name is None:
+        models.clear()
+    else:
+        models.pop(var_name, None)
+    for cache in (lookup_tables, padding_scores):
+        if var_name is None:
+            cache.clear()
+        else:
+            cache.pop(f"{var_name}_{model_name}", None)
+
+
+# preloading
+
+
+def preload(var_names: List[str], model_name: str = "brm"):
+    """
+    Load the models and templates of every variable concurrently and set the
+    ready event once all of them are available. If loading fails the error is
+    logged and kept in preload_error, and the service never becomes ready
+    """
+    global preload_error
+    try:
+        with ThreadPoolExecutor(max_workers=PRELOAD_WORKERS) as executor:
+            futures = [executor.submit(get_model, var_name) for var_name in var_names]
+            futures += [
+                executor.submit(templates.get, var_name, model_name)
+                for var_name in var_names
+            ]
+            for future in futures:
+                future.result()
+    except Exception as e:
+        preload_error = e
+        print(f"Preloading models and templates of {var_names} failed: {e!r}")
+        return
+    ready.set()
+    print(f"Preloaded models and templates of {var_names}")
+
+
+def start_preload(var_names: List[str], model_name: str = "brm"):
+    """
+    Run preload in a background thread. Only the first call starts it
+    """
+    global preload_thread
+    with preload_lock:
+        if preload_thread is None:
+            preload_thread = threading.Thread(
+                target=preload, args=(var_names, model_name), daemon=True
+            )
+            preload_thread.start()
@@ -0,0 +1 @@
+# makes the api and functions packages importable from the tests
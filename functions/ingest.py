@@ -1,10 +1,13 @@
-import io
 import os
 import json
 import boto3
-import pandas as pd
 import psycopg2
+import pyarrow.parquet as pq
+from pyarrow import fs
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List
+from functions.jobs import read_row_groups, schedule
 from functions.tables import (
     BaseTable,
     Departments,
@@ -13,7 +16,8 @@ from functions.tables import (
     MunicipalityPopulationHistory,
     InterfamilyViolence,
     Suicides,
-    SuicideAttempts
+    SuicideAttempts,
+    DataVersions
 )
 
 # contants
@@ -27,6 +31,7 @@ TABLES_DICT: Dict[str, List[BaseTable]] = {
     "attempts": [SuicideAttempts],
     "interfamily": [InterfamilyViolence]
 }
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", 4))
 
 # functions
 
@@ -39,26 +44,61 @@ def get_secret(aws: boto3.Session, secret_name: str) -> Dict[str, str]:
     secret = response["SecretString"]
     return json.loads(secret)
 
+
+def connect() -> psycopg2.extensions.connection:
+    return psycopg2.connect(
+        host=db_secret["host"],
+        database=db_secret["dbname"],
+        user=db_secret["username"],
+        password=db_secret["password"]
+    )
+
+
+def ingest_file(bucket: str, key: str, tables: List[BaseTable], cur, conn):
+    """
+    Create the tables of a file and ingest its data into them
+    """
+    parquet = pq.ParquetFile(s3.open_input_file(f"{bucket}/{key}"))
+
+    for table in tables:
+        print(f"Ingesing data into {table.name} ({key})")
+        deleted = table.create_table(cur, conn)
+        inserted, updated = table.insert_data(
+            read_row_groups(parquet, table.source_columns), cur, conn
+        )
+        # cached api responses stay valid when the load changed nothing
+        if deleted + inserted + updated:
+            DataVersions.bump(table.name, cur, conn)
+
+    print(f"Data ingestion of {key} succesfull")
+
+
+def ingest_file_concurrently(bucket: str, key: str, tables: List[BaseTable]):
+    """
+    Ingest a file over its own connection, so it can run alongside other files
+    """
+    with closing(connect()) as worker_conn:
+        ingest_file(bucket, key, tables, worker_conn.cursor(), worker_conn)
+
 # intialization
 
 aws = boto3.Session()
-s3 = aws.resource("s3")
+# ranged reads, so only the column chunks that are used are downloaded
+s3 = fs.S3FileSystem(region=aws.region_name)
 db_secret = get_secret(aws, SECRET_NAME)
-conn = psycopg2.connect(
-    host=db_secret["host"],
-    database=db_secret["dbname"],
-    user=db_secret["username"],
-    password=db_secret["password"]
-)
+conn = connect()
 cur = conn.cursor()
+DataVersions.create_table(cur, conn)
 
 # handler
 def handler(event, context):
     """
     Entry point for the lambda function.
 
-    Identify table corresponding to file, create it and ingest data from the file to it
+    Identify table corresponding to each file, create it and ingest data from the
+    file to it
     """
+    jobs = []
     for record in event["Records"]:
         bucket = record["s3"]["bucket"]["name"]
         key = record["s3"]["object"]["key"]
@@ -68,19 +108,19 @@ def handler(event, context):
         print(f"Processing {filename_prefix} ({key})")
 
         if tables:
-            buffer = io.BytesIO()        
-            s3_obj = s3.Object(bucket, key)
-            s3_obj.download_fileobj(buffer)
-            df = pd.read_parquet(buffer)
-
-            for table in tables:
-                print(f"Ingesing data into {table.name}")
-                table.create_table(cur, conn)
-                table.insert_data(df, cur, conn)
-    
-            print("Data ingestion succesfull")
+            jobs.append((bucket, key, tables))
         else:
             print("No tables associated to file found by prefix")
 
+    # files run in foreign key order, independent files run concurrently
+    for stage in schedule(jobs):
+        if len(stage) == 1:
+            ingest_file(*stage[0], cur, conn)
+            continue
+        workers = min(INGEST_WORKERS, len(stage))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(ingest_file_concurrently, *job) for job in stage]
+            for future in futures:
+                future.result()
 
     return {"status": 200}
@@ -0,0 +1,56 @@
+import re
+from typing import TYPE_CHECKING, Iterator, List, Set, Tuple
+
+if TYPE_CHECKING:
+    import pandas as pd
+    import pyarrow.parquet as pq
+    from functions.tables import BaseTable
+
+
+def read_row_groups(
+    parquet: "pq.ParquetFile", columns: List[str]
+) -> Iterator["pd.DataFrame"]:
+    """
+    Read a parquet file one row group at a time, only loading the given columns
+    """
+    for i in range(parquet.num_row_groups):
+        yield parquet.read_row_group(i, columns=columns).to_pandas()
+
+
+def table_dependencies(table: "BaseTable") -> Set[str]:
+    """
+    Names of the tables referenced by the foreign keys of a table
+    """
+    references = re.findall(r"references\s+(\w+)", table.create_statement, re.I)
+    return {name.lower() for name in references} - {table.table.lower()}
+
+
+def schedule(jobs: List[Tuple[str, str, List["BaseTable"]]]) -> List[List[Tuple]]:
+    """
+    Split (bucket, key, tables) ingestion jobs in stages that must run one after
+    the other. A job runs after the jobs loading the tables its foreign keys
+    reference and after earlier jobs loading the same tables. Jobs in the same
+    stage are independent
+    """
+    names = [{table.table.lower() for table in tables} for _, _, tables in jobs]
+    needs = [
+        set().union(*(table_dependencies(table) for table in tables))
+        for _, _, tables in jobs
+    ]
+    depends = {
+        i: {
+            j
+            for j in range(len(jobs))
+            if j != i and (needs[i] & names[j] or (j < i and names[i] & names[j]))
+        }
+        for i in range(len(jobs))
+    }
+
+    stages, done = [], set()
+    while len(done) < len(jobs):
+        stage = [i for i in depends if i not in done and depends[i] <= done]
+        if not stage:
+            raise ValueError("Circular foreign key dependency between files")
+        stages.append([jobs[i] for i in stage])
+        done.update(stage)
+    return stages
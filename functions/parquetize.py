@@ -1,9 +1,15 @@
 import io
+import os
 import json
 import boto3
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from functions.schemas import SCHEMAS
 
 SEMICOLON_FILES = {"department", "municipality"}
+CSV_CHUNK_ROWS = int(os.environ.get("CSV_CHUNK_ROWS", 100_000))  # rows per row group
+UPLOAD_PART_SIZE = 8 * 1024 * 1024  # s3 requires parts of at least 5 MiB
 
 
 def sizeof_fmt(num, suffix="B"):
@@ -20,6 +26,89 @@ def sizeof_fmt(num, suffix="B"):
 s3 = boto3.client("s3")
 
 
+class MultipartUpload(io.RawIOBase):
+    """
+    Write only file object that uploads everything written to it as a s3
+    multipart upload, holding at most one part in memory. The upload is
+    completed on close and aborted if the context exits with an error or
+    completing it fails
+    """
+
+    def __init__(self, bucket: str, key: str, part_size: int = UPLOAD_PART_SIZE):
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.upload_id = s3.create_multipart_upload(Bucket=bucket, Key=key)["UploadId"]
+        self.parts = []
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            self._upload_part(bytes(self.buffer[: self.part_size]))
+            del self.buffer[: self.part_size]
+        return len(data)
+
+    def _upload_part(self, body: bytes):
+        part_number = len(self.parts) + 1
+        response = s3.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self.upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+
+    def close(self):
+        """
+        Complete the upload. Content smaller than a part is uploaded with a
+        single put_object instead. The upload is aborted if completing it fails
+        """
+        if self.closed:
+            return
+        if not self.parts:
+            try:
+                s3.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            finally:
+                self.abort()
+            return
+        try:
+            if self.buffer:
+                self._upload_part(bytes(self.buffer))
+                self.buffer.clear()
+            s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        except Exception:
+            self.abort()
+            raise
+        super().close()
+
+    def abort(self):
+        s3.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+        )
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
 def handler(event, context):
     """
     Entry point for the lambda function.
@@ -35,14 +124,34 @@ def handler(event, context):
 
         print(f"Loading s3://{bucket}/{key} of size {sizeof_fmt(size)} bytes")
         csv_bytes = s3.get_object(Bucket=bucket, Key=key).get("Body")
-        df = pd.read_csv(
-            csv_bytes, sep=";" if filename_prefix in SEMICOLON_FILES else ","
+        schema = SCHEMAS.get(filename_prefix)
+        chunks = pd.read_csv(
+            csv_bytes,
+            sep=";" if filename_prefix in SEMICOLON_FILES else ",",
+            dtype=schema.pandas_dtypes() if schema else None,
+            chunksize=CSV_CHUNK_ROWS,
         )
 
+        # stream the csv chunk by chunk, each chunk written as a parquet row
+        # group and uploaded in parts as soon as enough bytes are written
         pq_key = key.replace("preprocessed", "parquetized").replace("csv", "parquet")
-        with io.BytesIO() as pq_buffer:
-            df.to_parquet(pq_buffer, index=False)
-            s3.put_object(Bucket=bucket, Key=pq_key, Body=pq_buffer.getvalue())
+        with MultipartUpload(bucket, pq_key) as pq_sink:
+            writer = None
+            for chunk in chunks:
+                if writer is None:
+                    pq_schema = schema.arrow_schema(chunk) if schema else None
+                    table = pa.Table.from_pandas(
+                        chunk, schema=pq_schema, preserve_index=False
+                    )
+                    options = schema.writer_options(table.schema) if schema else {}
+                    writer = pq.ParquetWriter(pq_sink, table.schema, **options)
+                else:
+                    table = pa.Table.from_pandas(
+                        chunk, schema=writer.schema, preserve_index=False
+                    )
+                writer.write_table(table)
+            if writer is not None:
+                writer.close()
 
         pq_size = s3.head_object(Bucket=bucket, Key=pq_key).get("ContentLength")
         print(
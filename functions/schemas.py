@@ -0,0 +1,130 @@
+import pyarrow as pa
+import pandas as pd
+from typing import Dict, NamedTuple, Optional
+
+NAME = pa.dictionary(pa.int32(), pa.string())  # repeated names
+
+
+class ParquetSchema(NamedTuple):
+    """
+    Column types and parquet settings used to convert the files of a prefix
+    """
+
+    types: Dict[str, pa.DataType]
+    # type of the columns not listed in types, inferred by pandas if None
+    default_type: Optional[pa.DataType] = None
+    compression: str = "zstd"
+    # parquet encoding of some columns, they are not dictionary encoded
+    encodings: Dict[str, str] = {}
+
+    def pandas_dtypes(self) -> Dict[str, str]:
+        """
+        Dtypes to read the listed columns from csv without losing information
+        """
+        dtypes = {}
+        for column, dtype in self.types.items():
+            if pa.types.is_integer(dtype):
+                dtypes[column] = f"Int{dtype.bit_width}"
+            elif pa.types.is_floating(dtype):
+                dtypes[column] = "float64"
+            else:
+                dtypes[column] = "object"
+        return dtypes
+
+    def arrow_schema(self, df: pd.DataFrame) -> pa.Schema:
+        """
+        Arrow schema of a chunk of the file, listed types override the
+        inferred ones
+        """
+        inferred = pa.Schema.from_pandas(df, preserve_index=False)
+        fields = []
+        for field in inferred:
+            dtype = self.types.get(field.name, self.default_type or field.type)
+            fields.append(pa.field(field.name, dtype))
+        return pa.schema(fields)
+
+    def writer_options(self, schema: pa.Schema) -> Dict:
+        """
+        Keyword arguments of pyarrow.parquet.ParquetWriter
+        """
+        options = {
+            "compression": self.compression,
+            "use_dictionary": [
+                name for name in schema.names if name not in self.encodings
+            ],
+        }
+        if self.encodings:
+            options["column_encoding"] = self.encodings
+        return options
+
+
+COORDINATES = {"LATITUD": pa.float64(), "LONGITUD": pa.float64()}
+COORDINATES_ENCODING = {"LATITUD": "BYTE_STREAM_SPLIT", "LONGITUD": "BYTE_STREAM_SPLIT"}
+
+# keyed by the filename prefixes in SEMICOLON_FILES and TABLES_DICT
+SCHEMAS: Dict[str, ParquetSchema] = {
+    "department": ParquetSchema(
+        types={
+            "DP": pa.int8(),
+            "DPNOM": NAME,
+            "AÑO": pa.int16(),
+            "ÁREA GEOGRÁFICA": NAME,
+        },
+        # population by gender and age plus totals
+        default_type=pa.int32(),
+    ),
+    "municipality": ParquetSchema(
+        types={
+            "DP": pa.int8(),
+            "DPNOM": NAME,
+            "COD_MUNICIPIO": pa.int32(),
+            "MPNOM": NAME,
+            "AÑO": pa.int16(),
+            "ÁREA GEOGRÁFICA": NAME,
+            "Total": pa.int32(),
+        },
+    ),
+    "municipalities": ParquetSchema(
+        types={
+            "COD_MUNICIPIO": pa.int32(),
+            "MPNOM": pa.string(),
+            "DP": pa.int8(),
+            **COORDINATES,
+        },
+        encodings=COORDINATES_ENCODING,
+    ),
+    "suicides": ParquetSchema(
+        types={
+            "YEAR": pa.int16(),
+            "DPTO": NAME,
+            "CODE_DPTO": pa.int8(),
+            "MUNICIPIO": NAME,
+            "CODE_MUNICIPIO": pa.int32(),
+            "SUI_COUNTER": pa.int32(),
+            "POPULATION": pa.int32(),
+            **COORDINATES,
+        },
+        encodings=COORDINATES_ENCODING,
+    ),
+    "attempts": ParquetSchema(
+        types={
+            "YEAR": pa.int16(),
+            "WEEK": pa.int8(),
+            "COUNTER_TRY": pa.int32(),
+            "CODE_MUNICIPIO": pa.int32(),
+        },
+    ),
+    "interfamily": ParquetSchema(
+        types={
+            "YEAR": pa.int16(),
+            "MUNICIPIO": NAME,
+            "DPTO": NAME,
+            "CODE_DPTO": pa.int8(),
+            "CODE_MUNICIPIO": pa.int32(),
+            "CANTIDAD": pa.int32(),
+            "POPULATION": pa.int32(),
+            **COORDINATES,
+        },
+        encodings=COORDINATES_ENCODING,
+    ),
+}
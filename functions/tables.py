@@ -1,25 +1,43 @@
+import io
+import os
 import numpy as np
 import pandas as pd
+from typing import Iterable, List, Tuple, Union
 from psycopg2.extras import execute_batch
 from psycopg2.extensions import cursor, connection
 
+# "copy" stages rows with COPY FROM STDIN, "batch" falls back to execute_batch
+LOAD_METHOD = os.environ.get("LOAD_METHOD", "copy")
+COPY_CHUNK_ROWS = int(os.environ.get("COPY_CHUNK_ROWS", 100_000))
+
 
 class BaseTable:
     """
     Base class to define common behaviors and attributes that all tables have
     """
     name: str
+    table: str  # name of the table in the database
+    columns: List[str]  # columns filled by insert, in prepare_data order
+    natural_key: Tuple[str, ...]  # columns identifying a row across loads
+    source_columns: List[str]  # columns of the source file, in columns order
     create_statement: str
-    insert_statement: str
+    # secondary indexes, dropped during bulk loads and rebuilt afterwards
+    indexes: List[Tuple[str, ...]] = []
+    # indexes of earlier versions of the table, dropped if they still exist
+    retired_indexes: List[Tuple[str, ...]] = []
+    # whether the natural key is the primary key, otherwise a unique index
+    # on it is created along with the table
+    natural_key_is_primary: bool = False
 
     @classmethod
     def prepare_data(cls, df: pd.DataFrame) -> pd.DataFrame:
-        raise NotImplementedError()
+        return df[cls.source_columns]
 
     @classmethod
-    def create_table(cls, cur: cursor, conn: connection):
+    def create_table(cls, cur: cursor, conn: connection) -> int:
         """
-        Create table using the class create statement
+        Create table using the class create statement. Returns the number of
+        duplicated rows removed to create its unique key
         """
         try:
             cur.execute(cls.create_statement)
@@ -28,25 +46,198 @@ class BaseTable:
         except Exception as e:
             conn.rollback()
             raise
+        return cls.create_unique_key(cur, conn)
+
+    @classmethod
+    def unique_key_name(cls) -> str:
+        return f"{cls.table}_{'_'.join(cls.natural_key)}_key".lower()
+
+    @classmethod
+    def create_unique_key(cls, cur: cursor, conn: connection) -> int:
+        """
+        Create the unique index on the natural key that merges rely on. Rows
+        duplicated by loads made before it existed are removed first, keeping
+        the oldest copy. Returns the number of removed rows
+        """
+        deleted = 0
+        if cls.natural_key_is_primary:
+            return deleted
+        try:
+            cur.execute("SELECT to_regclass(%s)", [cls.unique_key_name()])
+            if cur.fetchone()[0] is None:
+                match = " AND ".join(
+                    f"t.{column} = d.{column}" for column in cls.natural_key
+                )
+                cur.execute(
+                    f"DELETE FROM {cls.table} t USING {cls.table} d "
+                    f"WHERE {match} AND d.ctid < t.ctid"
+                )
+                deleted = cur.rowcount
+                if deleted:
+                    print(f"{cls.name}: {deleted} duplicated rows removed")
+                cur.execute(
+                    f"CREATE UNIQUE INDEX IF NOT EXISTS {cls.unique_key_name()} "
+                    f"ON {cls.table} ({', '.join(cls.natural_key)})"
+                )
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise
+        return deleted
+
+    @classmethod
+    def index_name(cls, columns: Tuple[str, ...]) -> str:
+        return f"{cls.table}_{'_'.join(columns)}_idx".lower()
+
+    @classmethod
+    def drop_indexes(cls, cur: cursor):
+        """
+        Drop the secondary indexes of the table before a bulk load
+        """
+        for columns in cls.indexes + cls.retired_indexes:
+            cur.execute(f"DROP INDEX IF EXISTS {cls.index_name(columns)}")
+
+    @classmethod
+    def create_indexes(cls, cur: cursor):
+        """
+        Build the secondary indexes of the table and refresh its statistics
+        after a bulk load
+        """
+        for columns in cls.indexes:
+            cur.execute(
+                f"CREATE INDEX IF NOT EXISTS {cls.index_name(columns)} "
+                f"ON {cls.table} ({', '.join(columns)})"
+            )
+        cur.execute(f"ANALYZE {cls.table}")
+
+    @classmethod
+    def staging_table(cls) -> str:
+        return f"{cls.table}_staging"
 
     @classmethod
-    def insert_data(cls, df: pd.DataFrame, cur: cursor, conn: connection):
+    def create_staging(cls, cur: cursor):
         """
-        Ingest data into the table
+        Create an empty temporary table with the insert columns of the table.
+        It is dropped when the transaction ends
         """
-        data = cls.prepare_data(df)
-        rows = [list(row) for row in data.itertuples(index=False)]
+        cur.execute(f"DROP TABLE IF EXISTS pg_temp.{cls.staging_table()}")
+        cur.execute(
+            f"CREATE TEMPORARY TABLE {cls.staging_table()} ON COMMIT DROP AS "
+            f"SELECT {', '.join(cls.columns)} FROM {cls.table} WITH NO DATA"
+        )
+
+    @classmethod
+    def copy_data(cls, data: pd.DataFrame, cur: cursor):
+        """
+        Stream prepared data into the staging table with COPY, one chunk of rows
+        at a time so memory is bounded by the chunk size
+        """
+        statement = (
+            f"COPY {cls.staging_table()} ({', '.join(cls.columns)}) "
+            "FROM STDIN WITH (FORMAT csv)"
+        )
+        for start in range(0, len(data), COPY_CHUNK_ROWS):
+            chunk = data.iloc[start : start + COPY_CHUNK_ROWS]
+            # floats holding integers (e.g. because of missing values) must be
+            # written without decimals to be accepted by integer columns
+            for column in chunk.select_dtypes(include="floating").columns:
+                values = chunk[column].dropna()
+                if (values == np.floor(values)).all():
+                    chunk = chunk.astype({column: "Int64"})
+            with io.StringIO() as buffer:
+                chunk.to_csv(buffer, header=False, index=False)
+                buffer.seek(0)
+                cur.copy_expert(statement, buffer)
+
+    @classmethod
+    def stage_data(cls, data: pd.DataFrame, cur: cursor):
+        """
+        Load prepared data into the staging table
+        """
+        if LOAD_METHOD == "copy":
+            cls.copy_data(data, cur)
+        else:
+            statement = (
+                f"INSERT INTO {cls.staging_table()} ({', '.join(cls.columns)}) "
+                f"VALUES ({', '.join(['%s'] * len(cls.columns))})"
+            )
+            rows = [list(row) for row in data.itertuples(index=False)]
+            execute_batch(cur, statement, rows)
+
+    @classmethod
+    def merge_staging(cls, cur: cursor) -> Tuple[int, int]:
+        """
+        Merge the staging table into the table by natural key. Rows with a new
+        key are inserted and existing rows are updated only if they changed.
+        Returns the number of inserted and updated rows
+        """
+        values = [column for column in cls.columns if column not in cls.natural_key]
+        key = ", ".join(cls.natural_key)
+        if values:
+            assignments = ", ".join(
+                f"{column} = EXCLUDED.{column}" for column in values
+            )
+            current = ", ".join(f"t.{column}" for column in values)
+            incoming = ", ".join(f"EXCLUDED.{column}" for column in values)
+            conflict = (
+                f"DO UPDATE SET {assignments} "
+                f"WHERE ({current}) IS DISTINCT FROM ({incoming})"
+            )
+        else:
+            conflict = "DO NOTHING"
+
+        # a row is inserted when its xmax is 0, otherwise it was updated
+        cur.execute(
+            f"INSERT INTO {cls.table} AS t ({', '.join(cls.columns)}) "
+            f"SELECT DISTINCT ON ({key}) {', '.join(cls.columns)} "
+            f"FROM {cls.staging_table()} "
+            f"ON CONFLICT ({key}) {conflict} "
+            "RETURNING xmax = 0"
+        )
+        rows = cur.fetchall()
+        inserted = sum(1 for (is_insert,) in rows if is_insert)
+        return inserted, len(rows) - inserted
+
+    @classmethod
+    def insert_data(
+        cls,
+        frames: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+        cur: cursor,
+        conn: connection,
+    ) -> Tuple[int, int]:
+        """
+        Ingest data into the table from a dataframe or an iterable of them, such
+        as the row groups of a file. Data is loaded into a staging table and
+        merged by natural key, so loading the same file again is idempotent.
+        Secondary indexes are dropped for the merge and rebuilt in the same
+        transaction, so a failed load leaves them in place.
+        Returns the number of inserted and updated rows
+        """
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
 
         try:
-            execute_batch(cur, cls.insert_statement, rows)
+            cls.create_staging(cur)
+            for df in frames:
+                cls.stage_data(cls.prepare_data(df), cur)
+            cls.drop_indexes(cur)
+            inserted, updated = cls.merge_staging(cur)
+            cls.create_indexes(cur)
             conn.commit()
         except Exception as e:
             conn.rollback()
             raise
+        print(f"{cls.name}: {inserted} rows inserted, {updated} rows updated")
+        return inserted, updated
 
 
 class Departments(BaseTable):
     name = "Departments"
+    table = "departments"
+    columns = ["code", "name"]
+    natural_key = ("code",)
+    natural_key_is_primary = True
+    source_columns = ["DP", "DPNOM"]
 
     create_statement = """--sql
     CREATE TABLE IF NOT EXISTS departments (
@@ -55,19 +246,18 @@ class Departments(BaseTable):
     )
     """
 
-    insert_statement = """--sql
-    INSERT INTO departments (
-        code, name
-    )
-    VALUES (%s, %s)
-    """
-
-    def prepare_data(df: pd.DataFrame) -> pd.DataFrame:
-        return df[["DP", "DPNOM"]].drop_duplicates()
+    @classmethod
+    def prepare_data(cls, df: pd.DataFrame) -> pd.DataFrame:
+        return df[cls.source_columns].drop_duplicates()
 
 
 class DepartmentsPopulationHistory(BaseTable):
     name = "DepartmentsPopulationHistory"
+    table = "departmentsPopulationHistory"
+    columns = ["year", "women", "men", "department_id"]
+    natural_key = ("year", "department_id")
+    source_columns = ["AÑO", "Total Mujeres", "Total Hombres", "DP"]
+    retired_indexes = [("year", "department_id")]
 
     create_statement = """--sql
     CREATE TABLE IF NOT EXISTS departmentsPopulationHistory (
@@ -79,19 +269,15 @@ class DepartmentsPopulationHistory(BaseTable):
     )
     """
 
-    insert_statement = """--sql
-    INSERT INTO departmentsPopulationHistory (
-        year, women, men, department_id
-    )
-    VALUES (%s, %s, %s, %s)
-    """
-
-    def prepare_data(df: pd.DataFrame) -> pd.DataFrame:
-        return df[["AÑO", "Total Mujeres", "Total Hombres", "DP"]]
-
 
 class Municipalities(BaseTable):
     name = "Municipalities"
+    table = "municipalities"
+    columns = ["code", "name", "latitude", "longitude", "department_id"]
+    natural_key = ("code",)
+    natural_key_is_primary = True
+    source_columns = ["COD_MUNICIPIO", "MPNOM", "LATITUD", "LONGITUD", "DP"]
+    indexes = [("department_id",)]
 
     create_statement: str = """--sql
     CREATE TABLE IF NOT EXISTS municipalities (
@@ -103,19 +289,14 @@ class Municipalities(BaseTable):
     )
     """
 
-    insert_statement: str = """--sql
-    INSERT INTO municipalities (
-        code, name, latitude, longitude, department_id
-    )
-    VALUES (%s, %s, %s, %s, %s)
-    """
-
-    def prepare_data(df: pd.DataFrame) -> pd.DataFrame:
-        return df[["COD_MUNICIPIO","MPNOM","LATITUD","LONGITUD","DP"]]
-
 
 class MunicipalityPopulationHistory(BaseTable):
     name = "MunicipalityPopulationHistory"
+    table = "municipalityPopulationHistory"
+    columns = ["year", "total", "municipality_id"]
+    natural_key = ("year", "municipality_id")
+    source_columns = ["AÑO", "Total", "COD_MUNICIPIO"]
+    retired_indexes = [("year", "municipality_id")]
 
     create_statement: str = """--sql
     CREATE TABLE IF NOT EXISTS municipalityPopulationHistory (
@@ -126,19 +307,14 @@ class MunicipalityPopulationHistory(BaseTable):
     )
     """
 
-    insert_statement: str = """--sql
-    INSERT INTO municipalityPopulationHistory (
-        year, total, municipality_id
-    )
-    VALUES (%s, %s, %s)
-    """
-
-    def prepare_data(df: pd.DataFrame) -> pd.DataFrame:
-        return df[["AÑO", "Total", "COD_MUNICIPIO"]]
-
 
 class InterfamilyViolence(BaseTable):
     name = "InterfamilyViolence"
+    table = "interfamilyViolence"
+    columns = ["year", "count", "municipality_id"]
+    natural_key = ("year", "municipality_id")
+    source_columns = ["YEAR", "CANTIDAD", "CODE_MUNICIPIO"]
+    retired_indexes = [("year", "municipality_id")]
 
     create_statement: str = """--sql
     CREATE TABLE IF NOT EXISTS interfamilyViolence (
@@ -149,19 +325,14 @@ class InterfamilyViolence(BaseTable):
     )
     """
 
-    insert_statement: str = """--sql
-    INSERT INTO interfamilyViolence (
-        year, count, municipality_id
-    )
-    VALUES (%s, %s, %s)
-    """
-
-    def prepare_data(df: pd.DataFrame) -> pd.DataFrame:
-        return df[["YEAR", "CANTIDAD", "CODE_MUNICIPIO"]]
-
 
 class Suicides(BaseTable):
     name = "Suicides"
+    table = "suicides"
+    columns = ["year", "count", "municipality_id"]
+    natural_key = ("year", "municipality_id")
+    source_columns = ["YEAR", "SUI_COUNTER", "CODE_MUNICIPIO"]
+    retired_indexes = [("year", "municipality_id")]
 
     create_statement: str = """--sql
     CREATE TABLE IF NOT EXISTS suicides (
@@ -172,19 +343,15 @@ class Suicides(BaseTable):
     )
     """
 
-    insert_statement: str = """--sql
-    INSERT INTO suicides (
-        year, count, municipality_id
-    )
-    VALUES (%s, %s, %s)
-    """
-
-    def prepare_data(df: pd.DataFrame) -> pd.DataFrame:
-        return df[["YEAR", "SUI_COUNTER", "CODE_MUNICIPIO"]]
-
 
 class SuicideAttempts(BaseTable):
     name = "SuicideAttempts"
+    table = "suicideAttempts"
+    columns = ["year", "week", "count", "municipality_id"]
+    natural_key = ("year", "week", "municipality_id")
+    source_columns = ["YEAR", "WEEK", "COUNTER_TRY", "CODE_MUNICIPIO"]
+    # the api reads the yearly rollup, which has its own index
+    retired_indexes = [("year", "municipality_id")]
 
     create_statement: str = """--sql
     CREATE TABLE IF NOT EXISTS suicideAttempts (
@@ -196,12 +363,99 @@ class SuicideAttempts(BaseTable):
     )
     """
 
-    insert_statement: str = """--sql
-    INSERT INTO suicideAttempts (
-        year, week, count, municipality_id
+    # weekly counts rolled up per municipality and year, read by the data api
+    rollup_statements: List[str] = [
+        """--sql
+        CREATE MATERIALIZED VIEW IF NOT EXISTS suicideAttemptsYearly AS
+        SELECT
+            year,
+            municipality_id,
+            sum(count) AS count
+        FROM suicideAttempts
+        GROUP BY year, municipality_id
+        """,
+        """--sql
+        CREATE UNIQUE INDEX IF NOT EXISTS suicideAttemptsYearly_year_municipality_idx
+            ON suicideAttemptsYearly (year, municipality_id)
+        """,
+    ]
+
+    refresh_statement: str = """--sql
+    REFRESH MATERIALIZED VIEW CONCURRENTLY suicideAttemptsYearly
+    """
+
+    @classmethod
+    def create_table(cls, cur: cursor, conn: connection) -> int:
+        """
+        Create the table and its yearly rollup, refreshing it if duplicated rows
+        had to be removed
+        """
+        deleted = super().create_table(cur, conn)
+        try:
+            for statement in cls.rollup_statements:
+                cur.execute(statement)
+            if deleted:
+                cur.execute(cls.refresh_statement)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise
+        return deleted
+
+    @classmethod
+    def insert_data(
+        cls,
+        frames: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+        cur: cursor,
+        conn: connection,
+    ) -> Tuple[int, int]:
+        """
+        Ingest data into the table and refresh its yearly rollup if it changed
+        """
+        inserted, updated = super().insert_data(frames, cur, conn)
+        if inserted + updated:
+            try:
+                cur.execute(cls.refresh_statement)
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                raise
+        return inserted, updated
+
+
+class DataVersions(BaseTable):
+    """
+    Version of the data of each table. Ingest bumps it after every successful
+    load so readers can tell when their cached data is stale
+    """
+    name = "DataVersions"
+    table = "dataVersions"
+    natural_key = ("table_name",)
+    natural_key_is_primary = True
+
+    create_statement: str = """--sql
+    CREATE TABLE IF NOT EXISTS dataVersions (
+        table_name VARCHAR(50) PRIMARY KEY,
+        version INTEGER NOT NULL,
+        updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
     )
-    VALUES (%s, %s, %s, %s)
     """
 
-    def prepare_data(df: pd.DataFrame) -> pd.DataFrame:
-        return df[["YEAR", "WEEK", "COUNTER_TRY", "CODE_MUNICIPIO"]]
+    bump_statement: str = """--sql
+    INSERT INTO dataVersions (table_name, version, updated_at)
+    VALUES (%s, 1, now())
+    ON CONFLICT (table_name) DO UPDATE
+        SET version = dataVersions.version + 1, updated_at = now()
+    """
+
+    @classmethod
+    def bump(cls, table_name: str, cur: cursor, conn: connection):
+        """
+        Increase the data version of a table
+        """
+        try:
+            cur.execute(cls.bump_statement, [table_name])
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            raise
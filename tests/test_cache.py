@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from api.data import cache as cache_module
+from api.data.cache import (
+    MISS,
+    ResponseCache,
+    etag_matches,
+    http_date,
+    is_not_modified,
+    make_etag,
+)
+
+UPDATED_AT = datetime(2022, 5, 1, 12, 30, 15, 250000, tzinfo=timezone.utc)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, "monotonic", clock)
+    return clock
+
+
+def test_get_returns_value_of_same_version(clock):
+    cache = ResponseCache()
+    assert cache.get("key", 1) is MISS
+    cache.set("key", 1, b"body")
+    assert cache.get("key", 1) == b"body"
+
+
+def test_new_version_invalidates_entry(clock):
+    cache = ResponseCache()
+    cache.set("key", 1, b"body")
+    assert cache.get("key", 2) is MISS
+    assert cache.get("key", 1) is MISS  # the stale entry was dropped
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = ResponseCache(ttl=10)
+    cache.set("key", 1, b"body")
+    clock.now = 10
+    assert cache.get("key", 1) == b"body"
+    clock.now = 10.5
+    assert cache.get("key", 1) is MISS
+
+
+def test_least_recently_used_entry_is_evicted(clock):
+    cache = ResponseCache(maxsize=2)
+    cache.set("a", 1, "a")
+    cache.set("b", 1, "b")
+    cache.get("a", 1)
+    cache.set("c", 1, "c")
+    assert cache.get("b", 1) is MISS
+    assert cache.get("a", 1) == "a"
+    assert cache.get("c", 1) == "c"
+
+
+def test_clear(clock):
+    cache = ResponseCache()
+    cache.set("key", 1, b"body")
+    cache.clear()
+    assert cache.get("key", 1) is MISS
+
+
+def test_etag_depends_on_key_and_version():
+    etag = make_etag(("suicides", 2020), (1,))
+    assert etag.startswith('"') and etag.endswith('"')
+    assert etag == make_etag(("suicides", 2020), (1,))
+    assert etag != make_etag(("suicides", 2021), (1,))
+    assert etag != make_etag(("suicides", 2020), (2,))
+
+
+def test_etag_matches():
+    etag = make_etag("key", 1)
+    assert etag_matches(etag, etag)
+    assert etag_matches(f'"other", W/{etag}', etag)
+    assert etag_matches("*", etag)
+    assert not etag_matches('"other"', etag)
+    assert not etag_matches(etag[1:-1], etag)  # unquoted
+
+
+def test_http_date():
+    bogota = timezone(timedelta(hours=-5))
+    assert http_date(UPDATED_AT.astimezone(bogota)) == "Sun, 01 May 2022 12:30:15 GMT"
+
+
+def test_not_modified_by_etag():
+    etag = make_etag("key", 1)
+    assert is_not_modified(etag, None, etag, UPDATED_AT)
+    assert not is_not_modified('"other"', None, etag, UPDATED_AT)
+
+
+def test_if_none_match_takes_precedence_over_if_modified_since():
+    etag = make_etag("key", 1)
+    since = http_date(UPDATED_AT)
+    assert not is_not_modified('"other"', since, etag, UPDATED_AT)
+
+
+def test_not_modified_since():
+    etag = make_etag("key", 1)
+    # http dates drop the microseconds of the last modification
+    assert is_not_modified(None, http_date(UPDATED_AT), etag, UPDATED_AT)
+    earlier = http_date(UPDATED_AT - timedelta(seconds=1))
+    assert not is_not_modified(None, earlier, etag, UPDATED_AT)
+
+
+def test_invalid_or_missing_conditions_are_modified():
+    etag = make_etag("key", 1)
+    assert not is_not_modified(None, None, etag, UPDATED_AT)
+    assert not is_not_modified(None, "yesterday", etag, UPDATED_AT)
+    assert not is_not_modified(None, http_date(UPDATED_AT), etag, None)
@@ -0,0 +1,88 @@
+from collections import namedtuple
+from decimal import Decimal
+
+import orjson
+import pytest
+
+from api.data import formats
+
+Column = namedtuple("Column", ["name", "type_code"])
+COLUMNS = [Column("code", 23), Column("name", 1043), Column("rate", 1700)]
+
+
+@pytest.fixture
+def with_pyarrow(monkeypatch):
+    monkeypatch.setattr(formats, "HAS_PYARROW", True)
+
+
+@pytest.fixture
+def without_pyarrow(monkeypatch):
+    monkeypatch.setattr(formats, "HAS_PYARROW", False)
+
+
+def test_negotiate_defaults_to_json(with_pyarrow):
+    assert formats.negotiate(None, None) == "json"
+    assert formats.negotiate(None, "*/*") == "json"
+
+
+def test_negotiate_prefers_format_parameter(with_pyarrow):
+    assert formats.negotiate("csv", "application/json") == "csv"
+    assert formats.negotiate("xml", None) is None
+
+
+def test_negotiate_by_quality(with_pyarrow):
+    accept = "application/json;q=0.5, text/csv;q=0.9, application/xml"
+    assert formats.negotiate(None, accept) == "csv"
+    assert formats.negotiate(None, "text/csv;q=0, application/json") == "json"
+    assert formats.negotiate(None, "application/vnd.apache.parquet") == "parquet"
+
+
+def test_negotiate_without_match(with_pyarrow):
+    assert formats.negotiate(None, "application/xml") is None
+    assert formats.negotiate(None, "text/csv;q=0") is None
+
+
+def test_arrow_formats_need_pyarrow(without_pyarrow):
+    assert formats.available_formats() == ["json", "csv"]
+    assert formats.negotiate("parquet", None) is None
+    assert formats.negotiate(None, "application/vnd.apache.arrow.stream") is None
+
+
+def test_encode_json_converts_decimals():
+    body = formats.encode_json({"data": [{"rate": Decimal("1.5")}]})
+    assert orjson.loads(body) == {"data": [{"rate": 1.5}]}
+
+
+def test_encode_csv_writes_header_once():
+    batches = [(COLUMNS, [(1, "a", 1.5)]), (COLUMNS, [(2, "b", None)])]
+    body = b"".join(formats.encode("csv", iter(batches)))
+    assert body.decode().splitlines() == ["code,name,rate", "1,a,1.5", "2,b,"]
+
+
+def test_encode_csv_of_empty_result():
+    body = b"".join(formats.encode("csv", iter([(COLUMNS, [])])))
+    assert body.decode().splitlines() == ["code,name,rate"]
+
+
+def test_arrow_schema_does_not_depend_on_values():
+    pa = pytest.importorskip("pyarrow")
+    batches = [(COLUMNS, [(1, None, None)]), (COLUMNS, [(2, "b", Decimal("2.5"))])]
+    body = b"".join(formats.encode("arrow", iter(batches)))
+
+    table = pa.ipc.open_stream(body).read_all()
+    assert table.schema.types == [pa.int32(), pa.string(), pa.float64()]
+    assert table.to_pydict() == {
+        "code": [1, 2],
+        "name": [None, "b"],
+        "rate": [None, 2.5],
+    }
+
+
+def test_encode_parquet():
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    batches = [(COLUMNS, [(1, None, None)]), (COLUMNS, [(2, "b", 2.5)])]
+    body = b"".join(formats.encode("parquet", iter(batches)))
+
+    table = pq.read_table(pa.BufferReader(body))
+    assert table.column("name").to_pylist() == [None, "b"]
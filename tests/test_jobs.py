@@ -0,0 +1,101 @@
+import pytest
+from functions.jobs import read_row_groups, schedule, table_dependencies
+
+
+class FakeRowGroup:
+    def __init__(self, data):
+        self.data = data
+
+    def to_pandas(self):
+        return self.data
+
+
+class FakeParquetFile:
+    def __init__(self, row_groups):
+        self.row_groups = row_groups
+        self.reads = []
+
+    @property
+    def num_row_groups(self):
+        return len(self.row_groups)
+
+    def read_row_group(self, i, columns=None):
+        self.reads.append((i, columns))
+        return FakeRowGroup({c: self.row_groups[i][c] for c in columns})
+
+
+def test_read_row_groups_reads_one_group_at_a_time():
+    parquet = FakeParquetFile([{"a": [1], "b": [2]}, {"a": [3], "b": [4]}])
+    groups = read_row_groups(parquet, ["a"])
+
+    assert parquet.reads == []  # lazy
+    assert next(groups) == {"a": [1]}
+    assert parquet.reads == [(0, ["a"])]
+    assert list(groups) == [{"a": [3]}]
+    assert parquet.reads == [(0, ["a"]), (1, ["a"])]
+
+
+def test_read_row_groups_of_empty_file():
+    assert list(read_row_groups(FakeParquetFile([]), ["a"])) == []
+
+
+def make_table(name, *references):
+    columns = ["code INTEGER"] + [
+        f"c{i} INTEGER REFERENCES {ref}(code)" for i, ref in enumerate(references)
+    ]
+    create_statement = f"CREATE TABLE {name} ({', '.join(columns)})"
+    return type(name, (), {"table": name, "create_statement": create_statement})
+
+
+departments = make_table("departments")
+department_population = make_table("departmentsPopulationHistory", "departments")
+municipalities = make_table("municipalities", "departments")
+municipality_population = make_table("municipalityPopulationHistory", "municipalities")
+suicides = make_table("suicides", "municipalities")
+violence = make_table("interfamilyViolence", "municipalities")
+
+
+def job(key, *tables):
+    return ("bucket", key, list(tables))
+
+
+def stage_keys(stages):
+    return [sorted(key for _, key, _ in stage) for stage in stages]
+
+
+def test_table_dependencies():
+    assert table_dependencies(departments) == set()
+    assert table_dependencies(suicides) == {"municipalities"}
+    tree = make_table("tree", "TREE", "Departments")
+    assert table_dependencies(tree) == {"departments"}
+
+
+def test_schedule_follows_foreign_keys():
+    jobs = [
+        job("suicides", suicides),
+        job("violence", violence),
+        job("municipality", municipality_population),
+        job("municipalities", municipalities),
+        job("department", departments, department_population),
+    ]
+    assert stage_keys(schedule(jobs)) == [
+        ["department"],
+        ["municipalities"],
+        ["municipality", "suicides", "violence"],
+    ]
+
+
+def test_schedule_runs_jobs_of_the_same_table_in_order():
+    jobs = [job("suicides_2016", suicides), job("suicides_2017", suicides)]
+    assert stage_keys(schedule(jobs)) == [["suicides_2016"], ["suicides_2017"]]
+
+
+def test_schedule_without_jobs():
+    assert schedule([]) == []
+
+
+def test_schedule_rejects_circular_dependencies():
+    a = make_table("a", "b")
+    b = make_table("b", "a")
+    with pytest.raises(ValueError):
+        schedule([job("a", a), job("b", b)])
@@ -0,0 +1,101 @@
+import json
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+for module in ("scipy", "joblib", "boto3"):
+    pytest.importorskip(module)
+
+# the predict service is deployed as a flat directory
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api", "predict"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+import utils  # noqa: E402
+
+VOCAB = {
+    "etag": '"model-v1"',
+    "municipalities": [["ANTIOQUIA", "MEDELLIN"], ["CAUCA", "SUAREZ"]],
+    "genders": ["FEMENINO", "MASCULINO"],
+    "values": ["Bullying", "Desamor"],
+}
+
+
+@pytest.fixture
+def lookup(tmp_path, monkeypatch):
+    """
+    Lookup table of the CAUSE variable where the probability of each cell is
+    its flat position divided by 10
+    """
+    monkeypatch.setattr(utils, "LOOKUP_DIR", str(tmp_path))
+    monkeypatch.setattr(utils, "lookup_tables", {})
+    monkeypatch.setattr(utils, "object_etag", lambda key: '"model-v1"')
+    probs_path, vocab_path = utils.lookup_paths("CAUSE")
+    np.save(probs_path, (np.arange(8, dtype=np.float32) / 10).reshape(2, 2, 2))
+    with open(vocab_path, "w") as f:
+        json.dump(VOCAB, f)
+    return tmp_path
+
+
+def test_lookup_hits(lookup):
+    records = [
+        ("ANTIOQUIA", "MEDELLIN", "FEMENINO", "Bullying"),
+        ("CAUCA", "SUAREZ", "MASCULINO", "Desamor"),
+    ]
+    probs = utils.lookup_probs("CAUSE", records)
+    assert probs == pytest.approx([0.0, 0.7])
+
+
+def test_lookup_misses_are_nan(lookup):
+    records = [
+        ("ANTIOQUIA", "MEDELLIN", "MASCULINO", "Desamor"),
+        ("ANTIOQUIA", "SUAREZ", "MASCULINO", "Desamor"),  # not a real pair
+        ("CAUCA", "SUAREZ", "OTRO", "Desamor"),
+        ("CAUCA", "SUAREZ", "MASCULINO", "Otra causa"),
+    ]
+    probs = utils.lookup_probs("CAUSE", records)
+    assert probs[0] == pytest.approx(0.3)
+    assert np.isnan(probs[1:]).all()
+
+
+def test_stale_lookup_is_ignored(lookup, monkeypatch):
+    monkeypatch.setattr(utils, "object_etag", lambda key: '"model-v2"')
+    records = [("ANTIOQUIA", "MEDELLIN", "FEMENINO", "Bullying")]
+    assert utils.load_lookup("CAUSE") is None
+    assert np.isnan(utils.lookup_probs("CAUSE", records)).all()
+
+
+def test_missing_lookup(lookup):
+    records = [("ANTIOQUIA", "MEDELLIN", "FEMENINO", "Bullying")]
+    assert np.isnan(utils.lookup_probs("AGE_GROUP", records)).all()
+
+
+def test_compute_probs_only_scores_misses(lookup, monkeypatch):
+    scored = []
+
+    def score_probs(var_name, records, model_name="brm"):
+        scored.extend(records)
+        return np.full(len(records), 0.5)
+
+    monkeypatch.setattr(utils, "score_probs", score_probs)
+    records = [
+        ("ANTIOQUIA", "MEDELLIN", "FEMENINO", "Desamor"),
+        ("CAUCA", "SUAREZ", "FEMENINO", "Otra causa"),
+    ]
+    assert utils.compute_probs("CAUSE", records) == pytest.approx([0.1, 0.5])
+    assert scored == [records[1]]
+
+
+def test_unknown_values_report_their_record(lookup, monkeypatch):
+    def score_probs(var_name, records, model_name="brm"):
+        raise utils.UnknownValueError("unknown value", 1)
+
+    monkeypatch.setattr(utils, "score_probs", score_probs)
+    records = [
+        ("CAUCA", "SUAREZ", "FEMENINO", "Otra causa"),
+        ("ANTIOQUIA", "MEDELLIN", "FEMENINO", "Desamor"),
+        ("CAUCA", "SUAREZ", "FEMENINO", "Desconocida"),
+    ]
+    with pytest.raises(utils.UnknownValueError) as error:
+        utils.compute_probs("CAUSE", records)
+    assert error.value.record == 2
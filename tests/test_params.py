@@ -0,0 +1,73 @@
+import pytest
+
+fastapi = pytest.importorskip("fastapi")
+
+from fastapi import HTTPException  # noqa: E402
+
+from api.data.params import page_payload, parse_fields, parse_metrics  # noqa: E402
+
+
+def test_parse_metrics_in_canonical_order():
+    assert parse_metrics(None) == ()
+    assert parse_metrics("") == ()
+    assert parse_metrics("percentile, rate,rate") == ("rate", "percentile")
+    assert parse_metrics("rate,percentile") == parse_metrics("percentile,rate")
+
+
+def test_parse_metrics_rejects_unknown_metrics():
+    with pytest.raises(HTTPException) as error:
+        parse_metrics("rate,median")
+    assert error.value.status_code == 422
+    assert "median" in error.value.detail
+
+
+def test_parse_fields_defaults_to_every_field():
+    assert parse_fields("suicides", None, ("rate",)) == (None, ("rate",))
+
+
+def test_parse_fields_always_includes_municipality_code():
+    fields, metrics = parse_fields("suicides", "population, suicides", ())
+    assert fields == ("municipality_code", "population", "suicides")
+    assert metrics == ()
+
+
+def test_parse_fields_adds_requested_metrics():
+    fields, metrics = parse_fields(
+        "suicide_attempts", "national_rank,suicide_attempts", ("percentile",)
+    )
+    assert fields == ("municipality_code", "suicide_attempts", "national_rank")
+    assert metrics == ("national_rank", "percentile")
+
+
+def test_parse_fields_rejects_unknown_fields():
+    with pytest.raises(HTTPException) as error:
+        # the count column of another case
+        parse_fields("suicides", "violence_cases", ())
+    assert error.value.status_code == 422
+    assert "violence_cases" in error.value.detail
+
+
+RECORDS = [{"municipality_code": code, "suicides": 1} for code in (5001, 5002, 5004)]
+
+
+def test_page_payload_points_to_the_next_page():
+    # queried with limit + 1 records
+    assert page_payload(2)(RECORDS) == {"data": RECORDS[:2], "next": 5002}
+
+
+def test_page_payload_of_the_last_page():
+    assert page_payload(3)(RECORDS) == {"data": RECORDS, "next": None}
+    assert page_payload(5)(RECORDS) == {"data": RECORDS, "next": None}
+    assert page_payload(2)([]) == {"data": [], "next": None}
+
+
+def test_page_payload_of_compact_records():
+    data = {
+        "columns": ["suicides", "municipality_code"],
+        "rows": [(1, 5001), (1, 5002), (1, 5004)],
+    }
+    assert page_payload(2)(data) == {
+        "data": {"columns": data["columns"], "rows": [(1, 5001), (1, 5002)]},
+        "next": 5002,
+    }
+    assert page_payload(3)(data)["next"] is None
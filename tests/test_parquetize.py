@@ -0,0 +1,100 @@
+import os
+
+import pytest
+
+for module in ("pandas", "pyarrow", "boto3"):
+    pytest.importorskip(module)
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+from functions import parquetize  # noqa: E402
+from functions.parquetize import MultipartUpload  # noqa: E402
+
+
+class FakeS3:
+    def __init__(self, fail_complete=False):
+        self.fail_complete = fail_complete
+        self.parts = []
+        self.objects = {}
+        self.completed = []
+        self.aborted = []
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": "upload-1"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts.append((PartNumber, Body))
+        return {"ETag": f'"etag-{PartNumber}"'}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        if self.fail_complete:
+            raise RuntimeError("complete failed")
+        self.completed.append((Key, MultipartUpload["Parts"]))
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted.append(UploadId)
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    s3 = FakeS3()
+    monkeypatch.setattr(parquetize, "s3", s3)
+    return s3
+
+
+def test_writes_are_split_into_parts(s3):
+    with MultipartUpload("bucket", "file.parquet", part_size=4) as sink:
+        sink.write(b"abc")
+        sink.write(b"defghij")
+        assert sink.tell() == 10
+        assert s3.parts == [(1, b"abcd"), (2, b"efgh")]
+
+    assert s3.parts[-1] == (3, b"ij")
+    assert s3.completed == [
+        (
+            "file.parquet",
+            [
+                {"PartNumber": 1, "ETag": '"etag-1"'},
+                {"PartNumber": 2, "ETag": '"etag-2"'},
+                {"PartNumber": 3, "ETag": '"etag-3"'},
+            ],
+        )
+    ]
+    assert s3.aborted == []
+    assert sink.closed
+
+
+@pytest.mark.parametrize("content", [b"", b"small"])
+def test_content_smaller_than_a_part_is_put(s3, content):
+    with MultipartUpload("bucket", "file.parquet", part_size=8) as sink:
+        sink.write(content)
+
+    assert s3.objects == {"file.parquet": content}
+    assert s3.parts == []
+    assert s3.completed == []
+    # the unused multipart upload is not left behind
+    assert s3.aborted == ["upload-1"]
+
+
+def test_upload_is_aborted_when_completing_fails(s3):
+    s3.fail_complete = True
+    sink = MultipartUpload("bucket", "file.parquet", part_size=4)
+    sink.write(b"abcdef")
+    with pytest.raises(RuntimeError):
+        sink.close()
+
+    assert s3.aborted == ["upload-1"]
+    assert sink.closed
+
+
+def test_upload_is_aborted_when_the_context_exits_with_an_error(s3):
+    with pytest.raises(ValueError):
+        with MultipartUpload("bucket", "file.parquet", part_size=4) as sink:
+            sink.write(b"abcdef")
+            raise ValueError("chunk failed")
+
+    assert s3.aborted == ["upload-1"]
+    assert s3.completed == []
+    assert s3.objects == {}
@@ -0,0 +1,175 @@
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+from psycopg2 import InterfaceError, OperationalError  # noqa: E402
+from psycopg2.pool import PoolError  # noqa: E402
+
+from api.data import pool as pool_module  # noqa: E402
+from api.data.pool import ConnectionPool, is_broken  # noqa: E402
+
+
+class FakeCursor:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, statement, values=None):
+        self.conn.statements.append(statement)
+        if self.conn.broken:
+            self.conn.closed = 2
+            raise OperationalError("server closed the connection unexpectedly")
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.statements = []
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+class FakeThreadedConnectionPool:
+    def __init__(self, minconn, maxconn, **connect_kwargs):
+        self.free = []
+        self.opened = []
+        self.discarded = []
+
+    def getconn(self):
+        if self.free:
+            return self.free.pop()
+        conn = FakeConnection()
+        self.opened.append(conn)
+        return conn
+
+    def putconn(self, conn, close=False):
+        if close:
+            self.discarded.append(conn)
+        else:
+            self.free.append(conn)
+
+    def closeall(self):
+        pass
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(pool_module.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture
+def make_pool(monkeypatch, clock):
+    monkeypatch.setattr(
+        pool_module, "ThreadedConnectionPool", FakeThreadedConnectionPool
+    )
+
+    def make_pool(maxconn=2, **kwargs):
+        kwargs.setdefault("timeout", 0.01)
+        kwargs.setdefault("healthcheck_interval", 60)
+        return ConnectionPool(1, maxconn, **kwargs)
+
+    return make_pool
+
+
+def test_getconn_times_out_when_every_connection_is_in_use(make_pool):
+    pool = make_pool(maxconn=1)
+    conn = pool.getconn()
+    with pytest.raises(PoolError):
+        pool.getconn()
+
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+
+
+def test_idle_connections_are_pinged(make_pool, clock):
+    pool = make_pool()
+    conn = pool.getconn()
+    pool.putconn(conn)
+
+    clock.now = 30
+    assert pool.getconn() is conn
+    assert conn.statements == []
+    pool.putconn(conn)
+
+    clock.now = 100
+    assert pool.getconn() is conn
+    assert conn.statements == ["SELECT 1"]
+    assert conn.rollbacks == 1
+
+
+def test_broken_connections_are_replaced(make_pool, clock):
+    pool = make_pool()
+    conn = pool.getconn()
+    pool.putconn(conn)
+    conn.broken = True
+
+    clock.now = 100
+    fresh = pool.getconn()
+    assert fresh is not conn
+    assert pool._pool.discarded == [conn]
+
+
+def test_closed_connections_are_replaced_without_ping(make_pool):
+    pool = make_pool()
+    conn = pool.getconn()
+    pool.putconn(conn)
+    conn.closed = 1
+
+    assert pool.getconn() is not conn
+    assert conn.statements == []
+    assert pool._pool.discarded == [conn]
+
+
+def test_putconn_discards_closed_connections(make_pool):
+    pool = make_pool(maxconn=1)
+    conn = pool.getconn()
+    conn.closed = 2
+    pool.putconn(conn)
+
+    assert pool._pool.discarded == [conn]
+    assert pool._pool.free == []
+    # the slot is released
+    assert pool.getconn() is not conn
+
+
+def test_connection_rolls_back_on_error(make_pool):
+    pool = make_pool(maxconn=1)
+    with pytest.raises(ValueError):
+        with pool.connection() as conn:
+            raise ValueError("query failed")
+
+    assert conn.rollbacks == 1
+    assert pool._pool.free == [conn]
+    with pool.connection() as again:
+        assert again is conn
+
+
+def test_is_broken():
+    conn = FakeConnection()
+    assert not is_broken(conn, OperationalError("canceling statement"))
+    assert is_broken(conn, InterfaceError("connection already closed"))
+    assert is_broken(None, OperationalError("could not connect to server"))
+
+    conn.closed = 2
+    assert is_broken(conn, OperationalError("server closed the connection"))
@@ -0,0 +1,123 @@
+import os
+import sys
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pd = pytest.importorskip("pandas")
+for module in ("scipy", "joblib", "boto3"):
+    pytest.importorskip(module)
+
+from scipy.special import erf  # noqa: E402
+
+# the predict service is deployed as a flat directory
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api", "predict"))
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+import utils  # noqa: E402
+
+COLUMNS = [
+    "DPTO_ANTIOQUIA",
+    "DPTO_CAUCA",
+    "MUNICIPIO_MEDELLIN",
+    "MUNICIPIO_SUAREZ",
+    "GENDER_FEMENINO",
+    "GENDER_MASCULINO",
+    "CAUSE_Bullying",
+    "CAUSE_Desamor",
+]
+RECORDS = [
+    ("ANTIOQUIA", "MEDELLIN", "FEMENINO", "Bullying"),
+    ("ANTIOQUIA", "MEDELLIN", "MASCULINO", "Desamor"),
+    ("CAUCA", "SUAREZ", "FEMENINO", "Desamor"),
+    ("CAUCA", "SUAREZ", "MASCULINO", "Bullying"),
+]
+
+
+class FakeModel:
+    """
+    Linear scorer, so records score on both sides of the 0.98 threshold
+    """
+
+    def __init__(self, bias):
+        self.weights = np.linspace(0.0, 0.2, len(COLUMNS))
+        self.bias = bias
+
+    def score_samples(self, features):
+        return np.asarray(features, dtype=float) @ self.weights + self.bias
+
+
+def baseline_compute_probs_from_scores(scores):
+    if len(scores) == 1:
+        XMIN = np.sqrt(2) / 2
+        XMAX = 1.0
+        probs = ((scores - XMIN) / (XMAX - XMIN)).clip(0, 1.0).ravel()
+        return probs
+    pre_erf_scores = scores
+    std = np.std(scores)
+    if len(scores) >= 2 and std > 0.0:
+        pre_erf_scores = (scores - np.mean(scores)) / (np.std(scores) * np.sqrt(2))
+    else:
+        pre_erf_scores /= np.sqrt(2)
+    erf_score = erf(pre_erf_scores)
+    probs = erf_score.clip(0, 1.0).ravel()
+    return probs
+
+
+def baseline_compute_prob(model, template, dpto, municipio, gender, var_value):
+    """
+    compute_prob as it was before scoring was vectorized
+    """
+    df = template.head(10).copy()
+    record_features = [
+        f"DPTO_{dpto}",
+        f"MUNICIPIO_{municipio}",
+        f"GENDER_{gender}",
+        f"CAUSE_{var_value}",
+    ]
+    df.loc[0, record_features] = 1
+    decision_scores = np.array(model.score_samples(df))
+    decision_scores[decision_scores >= 0.98] = 1.8
+    return baseline_compute_probs_from_scores(decision_scores)[0]
+
+
+@pytest.fixture
+def scoring(tmp_path, monkeypatch):
+    """
+    Score the CAUSE variable with a fake model and a template of n_rows rows of
+    zeros, without a lookup table
+    """
+
+    def setup(n_rows, bias):
+        template = pd.DataFrame(np.zeros((n_rows, len(COLUMNS))), columns=COLUMNS)
+        path = tmp_path / f"template_{n_rows}.csv"
+        template.to_csv(path, index=False)
+        model = FakeModel(bias)
+
+        monkeypatch.setattr(utils, "download_cached", lambda key: str(path))
+        monkeypatch.setattr(utils, "templates", utils.TemplateCache())
+        monkeypatch.setattr(utils, "get_model", lambda var_name: model)
+        monkeypatch.setattr(utils, "padding_scores", {})
+        monkeypatch.setattr(utils, "lookup_tables", {"CAUSE_brm": None})
+        return model, template
+
+    return setup
+
+
+@pytest.mark.parametrize("bias", [0.3, 0.6, 1.0])
+@pytest.mark.parametrize("n_rows", [1, 3, 10, 20])
+def test_compute_probs_matches_baseline(scoring, n_rows, bias):
+    model, template = scoring(n_rows, bias)
+    expected = [baseline_compute_prob(model, template, *record) for record in RECORDS]
+
+    assert utils.compute_probs("CAUSE", RECORDS) == pytest.approx(expected)
+    assert utils.compute_prob(*RECORDS[0][:3], "CAUSE", RECORDS[0][3]) == (
+        pytest.approx(expected[0])
+    )
+
+
+def test_unknown_value_is_reported_with_its_record(scoring):
+    scoring(3, 0.3)
+    records = RECORDS[:2] + [("CAUCA", "SUAREZ", "MASCULINO", "Otra causa")]
+    with pytest.raises(utils.UnknownValueError) as error:
+        utils.compute_probs("CAUSE", records)
+    assert error.value.record == 2
@@ -0,0 +1,106 @@
+import os
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+psycopg2 = pytest.importorskip("psycopg2")
+
+from functions.tables import BaseTable  # noqa: E402
+
+
+class Items(BaseTable):
+    name = "Items"
+    table = "test_items"
+    columns = ["code", "value"]
+    natural_key = ("code",)
+    source_columns = ["CODE", "VALUE"]
+
+    create_statement = """--sql
+    CREATE TABLE IF NOT EXISTS test_items (
+        id SERIAL PRIMARY KEY,
+        code INTEGER,
+        value INTEGER
+    )
+    """
+
+
+class FakeCursor:
+    def __init__(self, returned):
+        self.returned = returned
+        self.statements = []
+
+    def execute(self, statement, values=None):
+        self.statements.append(statement)
+
+    def fetchall(self):
+        return self.returned
+
+
+def test_merge_staging_upserts_changed_rows_only():
+    cur = FakeCursor([(True,), (False,), (True,)])
+    assert Items.merge_staging(cur) == (2, 1)
+
+    [statement] = cur.statements
+    assert "SELECT DISTINCT ON (code) code, value FROM test_items_staging" in statement
+    assert "ON CONFLICT (code) DO UPDATE SET value = EXCLUDED.value" in statement
+    assert "WHERE (t.value) IS DISTINCT FROM (EXCLUDED.value)" in statement
+
+
+def test_merge_staging_without_value_columns():
+    class Codes(Items):
+        columns = ["code"]
+
+    cur = FakeCursor([])
+    assert Codes.merge_staging(cur) == (0, 0)
+    assert "ON CONFLICT (code) DO NOTHING" in cur.statements[0]
+
+
+@pytest.fixture
+def db():
+    """
+    Connection to a scratch postgres database given by TEST_DATABASE_URL
+    """
+    url = os.environ.get("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    conn = psycopg2.connect(url)
+    cur = conn.cursor()
+    cur.execute("DROP TABLE IF EXISTS test_items")
+    conn.commit()
+    yield cur, conn
+    cur.execute("DROP TABLE IF EXISTS test_items")
+    conn.commit()
+    conn.close()
+
+
+def frame(rows):
+    return pd.DataFrame(rows, columns=Items.source_columns)
+
+
+def table_rows(cur):
+    cur.execute("SELECT code, value FROM test_items ORDER BY code")
+    return cur.fetchall()
+
+
+def test_insert_data_is_idempotent(db):
+    cur, conn = db
+    Items.create_table(cur, conn)
+
+    assert Items.insert_data(frame([[1, 10], [2, 20]]), cur, conn) == (2, 0)
+    assert Items.insert_data(frame([[1, 10], [2, 20]]), cur, conn) == (0, 0)
+    assert Items.insert_data(frame([[1, 11], [3, 30]]), cur, conn) == (1, 1)
+    assert table_rows(cur) == [(1, 11), (2, 20), (3, 30)]
+
+
+def test_create_table_removes_duplicates_of_earlier_loads(db):
+    cur, conn = db
+    cur.execute(Items.create_statement)
+    cur.execute("INSERT INTO test_items (code, value) VALUES (1, 10), (1, 10), (2, 20)")
+    conn.commit()
+
+    assert Items.create_table(cur, conn) == 1
+    assert table_rows(cur) == [(1, 10), (2, 20)]
+    assert Items.create_table(cur, conn) == 0
+    with pytest.raises(psycopg2.errors.UniqueViolation):
+        cur.execute("INSERT INTO test_items (code, value) VALUES (1, 10)")
+    conn.rollback()